@@ -1,4 +1,4 @@
 from .dialogform import DialogForm
-from .flowmanager import Flow
+from .flowmanager import Flow, FlowRegistry
 from .historymanager import HistoryManager
 from .render import TemplateRenderer
@@ -0,0 +1,10 @@
+import inspect
+
+
+async def maybe_await(value):
+    """
+        Await value if it's awaitable, so sync and async callables could be used the same way
+    """
+    if inspect.isawaitable(value):
+        return await value
+    return value
@@ -0,0 +1,112 @@
+"""
+    Single file bundle of templates tree.
+    Bundle is built from the folder layout TemplateRenderer expects and could be used instead of it:
+
+    $ knosk-bundle /path/to/app /path/to/templates.bundle --location templates
+
+    TemplateRenderer('/path/to/app', bundle_path='/path/to/templates.bundle')
+
+    Format: magic, 8 bytes little-endian length of index, json index {path: [offset, length]},
+    then utf-8 template sources. Paths are relative to application folder and use / as separator,
+    offsets are relative to the end of index
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'KNOSKTB1'
+_HEADER = struct.Struct('<8sQ')
+
+
+class TemplateBundle:
+    """
+        Read-only templates bundle, file is memory-mapped so sources are read on demand
+    """
+
+    def __init__(self, bundle_path):
+        self.bundle_path = bundle_path
+        with open(bundle_path, 'rb') as bundle_file:
+            self.__data = mmap.mmap(bundle_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_length = _HEADER.unpack_from(self.__data)
+        if magic != MAGIC:
+            raise ValueError("File %s is not a templates bundle" % bundle_path)
+        index_end = _HEADER.size + index_length
+        index = json.loads(self.__data[_HEADER.size:index_end].decode('utf-8'))
+        self.__entries = {}
+        self.__dirs = {}
+        for path, (offset, length) in index.items():
+            path = os.path.join(*path.split('/'))
+            self.__entries[path] = (index_end + offset, length)
+            dir_name, file_name = os.path.split(path)
+            self.__dirs.setdefault(dir_name, []).append(file_name)
+
+    def __contains__(self, path):
+        return os.path.normpath(path) in self.__entries
+
+    def get_source(self, path) -> str:
+        offset, length = self.__entries[os.path.normpath(path)]
+        return self.__data[offset:offset + length].decode('utf-8')
+
+    def walk(self, top, root=''):
+        """
+            Walk bundle like os.walk does, :top is folder inside :root and bundle paths are relative to :root
+        """
+        rel_top = os.path.normpath(os.path.relpath(top, root) if root else top)
+        for dir_name, file_names in self.__dirs.items():
+            if rel_top == os.curdir or dir_name == rel_top or dir_name.startswith(rel_top + os.sep):
+                yield os.path.join(root, dir_name), [], list(file_names)
+
+    def close(self):
+        self.__data.close()
+
+
+def build_bundle(app_path, bundle_path, locations=('templates',)) -> int:
+    """
+        Pack all templates of :locations to :bundle_path, returns number of packed templates
+    """
+    index = {}
+    sources = []
+    offset = 0
+    for tmpl_location in locations:
+        for dir_path, dir_names, file_names in os.walk(os.path.join(app_path, tmpl_location)):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if not file_name.endswith('.tmpl'):
+                    continue
+                template_path = os.path.join(dir_path, file_name)
+                with open(template_path, 'r') as tfile:
+                    source = tfile.read().encode('utf-8')
+                path = os.path.relpath(template_path, app_path).replace(os.sep, '/')
+                index[path] = [offset, len(source)]
+                sources.append(source)
+                offset += len(source)
+
+    index_data = json.dumps(index, sort_keys=True).encode('utf-8')
+    tmp_path = bundle_path + '.tmp'
+    with open(tmp_path, 'wb') as bundle_file:
+        bundle_file.write(_HEADER.pack(MAGIC, len(index_data)))
+        bundle_file.write(index_data)
+        for source in sources:
+            bundle_file.write(source)
+    os.replace(tmp_path, bundle_path)  # running renderers keep reading old bundle until rescan
+    return len(index)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='knosk-bundle', description='Pack knosk templates to single file bundle')
+    parser.add_argument('app_path', help='application folder which is passed to TemplateRenderer')
+    parser.add_argument('bundle_path', help='bundle file to create')
+    parser.add_argument('--location', action='append', dest='locations',
+                        help='tmpl_location to pack, could be passed several times (default: templates)')
+    args = parser.parse_args(argv)
+
+    packed = build_bundle(args.app_path, args.bundle_path, args.locations or ['templates'])
+    print("Packed %s templates to %s" % (packed, args.bundle_path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,18 @@
 from typing import List, Dict
 from knosk.fields import OverrideField, DialogField, FieldValue, ListField, OptionalField
 from knosk.core import serializer
+from concurrent.futures import ThreadPoolExecutor
+from knosk.core.asyncutils import maybe_await
+import asyncio
 import importlib
 import logging
+import threading
 import copy
 
 LOG = logging.getLogger(__name__)
 
+_match_executor_lock = threading.Lock()
+
 
 class DialogForm:
     class FormException(RuntimeError):
@@ -31,6 +37,66 @@ class DialogForm:
         """
         pass
 
+    _field_plan = ()
+    _missing_fields = ()
+    _field_dependents = {}
+    _field_order = ()
+    _payload_dependents = {}
+    # set to run matchers of independent fields concurrently on thread pool of this size
+    match_max_workers = None
+
+    def __init_subclass__(cls, **kwargs):
+        """
+            Compile field definitions of form class once, so building form instance doesn't need reflection.
+            Fields dependency graph is checked and ordered topologically here as well
+        """
+        super().__init_subclass__(**kwargs)
+        field_names = getattr(getattr(cls, 'Meta', None), 'fields', ())
+        # base form could list fields which are defined by its subclasses or mixins
+        cls._missing_fields = tuple(field_name for field_name in field_names if not hasattr(cls, field_name))
+        if cls._missing_fields:
+            field_names = ()
+        cls._field_plan = tuple((field_name, getattr(cls, field_name)) for field_name in field_names)
+        cls._field_dependents = {field_name: [] for field_name in field_names}
+        cls._payload_dependents = {}
+        for field_name, field_def in cls._field_plan:
+            for dependency in field_def.depends_on:
+                if dependency not in cls._field_dependents:
+                    raise ValueError("Field %s of form %s depends on unknown field %s" %
+                                     (field_name, cls.__name__, dependency))
+                cls._field_dependents[dependency].append(field_name)
+            for key in field_def.payload_keys:
+                cls._payload_dependents.setdefault(key, []).append(field_name)
+        cls._field_order = cls._sort_fields()
+
+    @classmethod
+    def _sort_fields(cls):
+        """
+            Order fields so every field goes after fields it depends on, otherwise keep Meta.fields order
+        """
+        order = []
+        visiting = set()
+        visited = set()
+        definitions = dict(cls._field_plan)
+
+        def visit(field_name, path):
+            if field_name in visited:
+                return
+            if field_name in visiting:
+                cycle = path[path.index(field_name):] + [field_name]
+                raise ValueError("Fields of form %s have cyclic dependency: %s" %
+                                 (cls.__name__, " -> ".join(cycle)))
+            visiting.add(field_name)
+            for dependency in definitions[field_name].depends_on:
+                visit(dependency, path + [field_name])
+            visiting.discard(field_name)
+            visited.add(field_name)
+            order.append(field_name)
+
+        for field_name, _ in cls._field_plan:
+            visit(field_name, [])
+        return tuple(order)
+
     def __init__(self,
                  payload: Dict[str,
                                str] = None,
@@ -41,6 +107,8 @@ class DialogForm:
         self.__payload = {} if not payload else payload
         self.__overrides = [] if not overrides else overrides
         self._fields = {}
+        self._dirty = None  # None means that every field is evaluated
+        self._evaluated = False
         self.history = history
         if self.__payload:  # if payload is None that means that form was instantiated for deserialization
             self.__dict__.update(kwargs)
@@ -51,45 +119,149 @@ class DialogForm:
             payload: dict,
             overrides: List[OverrideField],
             clean_field_data: str = None):
-        field_defs = {}
-        if 'Meta' in dir(self):
-            if 'fields' in dir(self.Meta):
-                field_defs = {
-                    field_name: getattr(self, field_name) for field_name in self.Meta.fields
-                }
-        for field_name, field_def in field_defs.items():
-            need_skip_payload = clean_field_data == field_name
-            LOG.info("Rebuild field %s-%s-%s" %
-                     (field_name, need_skip_payload, payload))
-            self._fields[field_name] = field_def.create(
-                payload,
-                overrides=overrides,
-                skip_payload=need_skip_payload)
+        if self._missing_fields:
+            raise AttributeError("Form %s has no fields %s" % (self.__class__.__name__, ", ".join(self._missing_fields)))
+        overrides = OverrideField.index(overrides)
+        self._dirty = None
+        self._evaluated = False
+        for field_name, field_def in self._field_plan:
+            self._build_field(field_name, field_def, payload, overrides, clean_field_data == field_name)
+
+    def _build_field(self, field_name, field_def, payload, overrides, skip_payload=False):
+        LOG.info("Rebuild field %s-%s-%s" %
+                 (field_name, skip_payload, payload))
+        self._fields[field_name] = field_def.create(
+            payload,
+            overrides=overrides,
+            skip_payload=skip_payload)
+
+    def _dependents(self, field_name) -> set:
+        """
+            :field_name with all fields which depend on it directly or transitively
+        """
+        affected = {field_name}
+        queue = [field_name]
+        while queue:
+            for dependent in self._field_dependents.get(queue.pop(), ()):
+                if dependent not in affected:
+                    affected.add(dependent)
+                    queue.append(dependent)
+        return affected
 
     def clone(self):
         return copy.deepcopy(self)
 
-    def match(self):
+    def match(self, executor=None):
+        """
+            Run matchers of fields, if :executor is passed or match_max_workers is set on form class
+            matchers of fields which don't depend on each other run concurrently
+        """
+        LOG.info("==== Start matching form %s ====" % self.__class__.__name__)
+        field_names = self._fields_to_match()
+        if executor is not None:
+            self._match_concurrently(field_names, executor)
+        elif self.match_max_workers:
+            self._match_concurrently(field_names, self._get_match_executor())
+        else:
+            for field_name in field_names:
+                self._fields[field_name].match(self)
+        LOG.info("==== End matching form %s ====" % self.__class__.__name__)
+
+    async def match_async(self, concurrent=False):
+        """
+            Same as match but matchers could be coroutine functions,
+            if :concurrent matchers of fields which don't depend on each other are awaited together
+        """
         LOG.info("==== Start matching form %s ====" % self.__class__.__name__)
-        for field in self._fields.values():
-            field.match(self)
+        field_names = self._fields_to_match()
+        if concurrent:
+            for wave in self._match_waves(field_names):
+                results = await asyncio.gather(
+                    *[self._fields[field_name].match_async(self) for field_name in wave], return_exceptions=True)
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+        else:
+            for field_name in field_names:
+                await self._fields[field_name].match_async(self)
         LOG.info("==== End matching form %s ====" % self.__class__.__name__)
 
+    def _fields_to_match(self):
+        field_names = []
+        for field_name in self._field_order:
+            if self._dirty is not None and field_name not in self._dirty:
+                LOG.info("Skipping clean field %s" % field_name)
+                continue
+            field_names.append(field_name)
+        return field_names
+
+    @classmethod
+    def _get_match_executor(cls) -> ThreadPoolExecutor:
+        """
+            Thread pool of form class which is created on first concurrent match and shared by all its instances
+        """
+        executor = cls.__dict__.get('_match_executor')
+        if executor is None:
+            with _match_executor_lock:
+                executor = cls.__dict__.get('_match_executor')
+                if executor is None:
+                    executor = ThreadPoolExecutor(cls.match_max_workers, thread_name_prefix=cls.__name__)
+                    cls._match_executor = executor
+        return executor
+
+    def _match_waves(self, field_names):
+        """
+            Split :field_names into waves, every field goes after all waves with fields it depends on
+        """
+        waves = []
+        wave_of = {}
+        for field_name in field_names:  # fields are ordered topologically already
+            wave = max([wave_of[dependency] + 1 for dependency in self._fields[field_name].depends_on
+                        if dependency in wave_of] or [0])
+            wave_of[field_name] = wave
+            if wave == len(waves):
+                waves.append([])
+            waves[wave].append(field_name)
+        return waves
+
+    def _match_concurrently(self, field_names, executor):
+        """
+            Every field stores its own match result so assignment doesn't depend on completion order.
+            Exception of the first field in match order is raised as in serial mode,
+            but fields of the same wave are matched anyway
+        """
+        for wave in self._match_waves(field_names):
+            futures = [executor.submit(self._fields[field_name].match, self) for field_name in wave]
+            errors = [future.exception() for future in futures]
+            for error in errors:
+                if error is not None:
+                    raise error
+
     @property
     def payload(self):
         return self.__payload
 
     def suggest(self) -> (str, DialogField):
         LOG.info("==== Start suggesting form %s ====" % self.__class__.__name__)
-        for field_name, field in self._fields.items():
-            is_optional_field = isinstance(field, OptionalField)
+        for field_name, field, suggested_result in self._fields_to_suggest():
+            if suggested_result is None:
+                suggested_result = field.suggest(self)
 
-            if FieldValue.is_empty(field.origin) and is_optional_field:
-                LOG.info("Skipping empty optional field {}".format(field_name))
-                # skipping optional field suggest
-                continue
+            if FieldValue.is_empty(suggested_result)\
+                    or FieldValue.is_suggested(suggested_result):
+                LOG.info("==== End suggesting form %s ====" % self.__class__.__name__)
+                return field_name, field
+        LOG.info("==== End suggesting form %s ====" % self.__class__.__name__)
+        return None
 
-            suggested_result = field.suggest(self)
+    async def suggest_async(self) -> (str, DialogField):
+        """
+            Same as suggest but suggesters and choosers could be coroutine functions
+        """
+        LOG.info("==== Start suggesting form %s ====" % self.__class__.__name__)
+        for field_name, field, suggested_result in self._fields_to_suggest():
+            if suggested_result is None:
+                suggested_result = await field.suggest_async(self)
 
             if FieldValue.is_empty(suggested_result)\
                     or FieldValue.is_suggested(suggested_result):
@@ -98,6 +270,27 @@ class DialogForm:
         LOG.info("==== End suggesting form %s ====" % self.__class__.__name__)
         return None
 
+    def _fields_to_suggest(self):
+        """
+            Yield fields to suggest in form order with result of last suggest for clean fields,
+            result is None if field should be suggested again
+        """
+        dirty, self._dirty = self._dirty, None
+        self._evaluated = True
+        for field_name, field in self._fields.items():
+            is_optional_field = isinstance(field, OptionalField)
+
+            if FieldValue.is_empty(field.origin) and is_optional_field:
+                LOG.info("Skipping empty optional field {}".format(field_name))
+                # skipping optional field suggest
+                continue
+
+            if dirty is not None and field_name not in dirty and not FieldValue.is_empty(field.suggested):
+                # clean field keeps result of its last suggest
+                yield field_name, field, field.suggested
+            else:
+                yield field_name, field, None
+
     def handle(self, **kwargs):
         """
             Just wrapper for form logic call: match->suggest->validate
@@ -110,6 +303,20 @@ class DialogForm:
             return suggest_result
         self.validate(**kwargs)
 
+    async def handle_async(self, **kwargs):
+        """
+            Async version of handle, matchers, suggesters, choosers, validate_field and validate_form
+            could be coroutine functions or plain functions. Fields are matched concurrently
+            if match_max_workers is set on form class
+        """
+        await self.match_async(concurrent=bool(self.match_max_workers))
+        suggest_result = await self.suggest_async()
+        if suggest_result:
+            field_name, field = suggest_result
+            await maybe_await(self.validate_field(field_name, field))
+            return suggest_result
+        await self.validate_async(**kwargs)
+
     def get_exclude(self, field_name) -> FieldValue:
         """
             For internal needs exclude could be None, but for external needs everything should be FieldValue
@@ -125,15 +332,49 @@ class DialogForm:
     def has(self, field_name: str) -> bool:
         return field_name in self._fields
 
-    def clean_field_data(self, field_name: str, overrides: List = None):
+    def clean_field_data(self, field_name: str, overrides: List = None, incremental=False):
         """
             Rebuild whole form that mean that all form field data will be removed(all suggests and matches)
             and fields will be reacreated with data from payload except :field_name.
             Payload data for :field_name will be hidden during rebuild
+            If :incremental only :field_name and fields which depend on it are rebuilt,
+            other fields keep their matches and suggests and aren't evaluated again on next match/suggest
         """
         if overrides:
             self.__overrides = self.__overrides + overrides
-        self._build_fields(self.__payload, self.__overrides, field_name)
+        if not incremental:
+            self._build_fields(self.__payload, self.__overrides, field_name)
+            return
+        self._invalidate(self._dependents(field_name), field_name)
+
+    def update_payload(self, payload: Dict[str, str]):
+        """
+            Replace payload of form e.g. with payload of next dialog turn.
+            Only fields which read changed payload keys and fields which depend on them are rebuilt and marked dirty,
+            so next match/suggest re-evaluates just them
+        """
+        old_payload, self.__payload = self.__payload, payload
+        if not self._evaluated:
+            self._build_fields(payload, self.__overrides)
+            return
+        affected = set()
+        for key in set(old_payload) | set(payload):
+            if key in old_payload and key in payload and old_payload[key] == payload[key]:
+                continue
+            for field_name in self._payload_dependents.get(key, ()):
+                affected |= self._dependents(field_name)
+        self._invalidate(affected)
+
+    def _invalidate(self, affected: set, skip_payload_field: str = None):
+        """
+            Rebuild :affected fields and mark them dirty
+        """
+        overrides = OverrideField.index(self.__overrides)
+        for field_name, field_def in self._field_plan:
+            if field_name in affected:
+                self._build_field(field_name, field_def, self.__payload, overrides, field_name == skip_payload_field)
+        if self._evaluated:
+            self._dirty = affected if self._dirty is None else self._dirty | affected
 
     def get_field_names(self):
         return list(self._fields.keys())
@@ -152,6 +393,12 @@ class DialogForm:
 
         self.validate_form(**kwargs)
 
+    async def validate_async(self, **kwargs):
+        for (fname, field) in self._fields.items():
+            await maybe_await(self.validate_field(fname, field))
+
+        await maybe_await(self.validate_form(**kwargs))
+
     def validate_field(self, fname: str, field: DialogField):
         """
         Run validator that validate state of form
@@ -185,6 +432,7 @@ class DialogForm:
             field_data = data['fields'].get(field_name, None)
             if field_data:
                 field.deserialize(field_data)
+        self._evaluated = True
 
     @classmethod
     def get_form(cls, data):
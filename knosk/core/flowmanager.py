@@ -1,4 +1,15 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import importlib
 import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from knosk.core.asyncutils import maybe_await
+from knosk.core.middleware import RouteCall
 
 LOG = logging.getLogger(__name__)
 
@@ -11,61 +22,712 @@ def default_fallback(ex, route_name, payload, ctx):
     raise ex
 
 
+class RouteTimeout(RuntimeError):
+    """
+        Route was not handled in time, it's passed to fallback
+    """
+    pass
+
+
+class RouteNotStarted(RouteTimeout):
+    """
+        Route was not run at all since no deadline thread was available in time
+        (route already holds all its deadline threads or shared pool is busy),
+        it's passed to fallback and is not counted as route failure
+    """
+    pass
+
+
+class CircuitOpen(RuntimeError):
+    """
+        Route failed too many times in a row and is not called until reset timeout passes,
+        it's passed to fallback
+    """
+    pass
+
+
+# size of thread pool shared by all flows to enforce route deadlines, it's the max number of sync routes
+# which are handled with deadline at once including timed out routes which are still running in background
+DEADLINE_WORKERS = 32
+# default max number of deadline threads which one route of flow could hold, so one hanging dependency
+# doesn't take the whole pool
+DEADLINE_ROUTE_WORKERS = 8
+
+_deadline_executor = None
+_deadline_executor_lock = threading.Lock()
+_deadline_local = threading.local()
+
+
+def _get_deadline_executor() -> ThreadPoolExecutor:
+    global _deadline_executor
+    if _deadline_executor is None:
+        with _deadline_executor_lock:
+            if _deadline_executor is None:
+                _deadline_executor = ThreadPoolExecutor(DEADLINE_WORKERS, thread_name_prefix='knosk-deadline')
+    return _deadline_executor
+
+
+def _run_under_deadline(slots, func, *args):
+    _deadline_local.active = True
+    try:
+        return func(*args)
+    finally:
+        _deadline_local.active = False
+        slots.release()
+
+
+def _call_with_timeout(timeout, slots, func, route_name, *args):
+    """
+        Call function in shared deadline pool and wait for result at most :timeout seconds.
+        Thread can't be stopped so timed out function keeps running in background and holds pool thread
+        and one of route :slots (semaphore) until it returns. Route without free slot or waiting in pool queue
+        longer than :timeout is not run at all and RouteNotStarted is raised.
+        Routes called from route which already runs under deadline (e.g. flow.render from handler)
+        run in the same thread and are covered by outer deadline
+    """
+    if getattr(_deadline_local, 'active', False):
+        return func(route_name, *args)
+    if not slots.acquire(blocking=False):
+        raise RouteNotStarted("Route %s holds all its deadline threads" % route_name)
+    try:
+        future = _get_deadline_executor().submit(_run_under_deadline, slots, func, route_name, *args)
+    except BaseException:
+        slots.release()
+        raise
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        if future.cancel():
+            slots.release()
+            raise RouteNotStarted("Route %s is not started in %s seconds" % (route_name, timeout))
+        raise RouteTimeout("Route %s is not handled in %s seconds" % (route_name, timeout))
+
+
+class CircuitBreaker:
+    """
+    Open after :threshold failures in a row, while open calls are rejected.
+    After :reset_timeout seconds single probe call is allowed, breaker is closed if it succeeds
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.__probing = False
+        self.__lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self.__lock:
+            if self.opened_at is None:
+                return True
+            if self.__probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.__probing = True
+            return True
+
+    def success(self):
+        with self.__lock:
+            self.failures = 0
+            self.opened_at = None
+            self.__probing = False
+
+    def failure(self):
+        with self.__lock:
+            self.failures += 1
+            if self.__probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.__probing = False
+
+    def release(self):
+        """
+            Call was interrupted (e.g. task was cancelled) without result, allow another probe
+        """
+        with self.__lock:
+            self.__probing = False
+
+
+def _memo_key(condition, payload):
+    """
+        Key of condition result in turn memo, all empty payloads (None or {} replaced by the flow) share one key
+    """
+    return condition, id(payload) if payload else None
+
+
 class SingleBotFlowFactory:
+    """
+    Single flow per process, use FlowRegistry to host many bots
+    """
     _botflow = None
+    _lock = threading.Lock()
 
     @classmethod
     def get(cls, fallback):
         if cls._botflow:
             return cls._botflow
-        else:
-            cls._botflow = Flow(fallback)
+        with cls._lock:
+            if not cls._botflow:
+                cls._botflow = Flow(fallback)
             return cls._botflow
 
 
+class _LazyCallable:
+    """
+    Callable given by "package.module:function" path which is imported on first call
+    """
+
+    def __init__(self, path):
+        module_name, _, func_name = path.partition(':')
+        if not module_name or not func_name:
+            raise ValueError('Callable path should be "package.module:function", got %r' % path)
+        self.path = path
+        self.__func = None
+        self.__lock = threading.Lock()
+
+    def resolve(self):
+        func = self.__func
+        if func is None:
+            with self.__lock:
+                if self.__func is None:
+                    module_name, func_name = self.path.split(':', 1)
+                    LOG.info("Import %s" % self.path)
+                    self.__func = getattr(importlib.import_module(module_name), func_name)
+                func = self.__func
+        return func
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        return "<lazy %s>" % self.path
+
+
+TurnResult = namedtuple('TurnResult', ['conversation_id', 'route_name', 'result', 'error'])
+
+
+class RouteTrie:
+    """
+    Routes storage with dotted wildcard routes support.
+    booking.* matches every route starting with booking. (but not booking itself), * matches every route.
+    Exact route wins, otherwise the most specific wildcard route wins.
+    Exact routes are looked up in dict, wildcard routes are compiled to trie by route name segments,
+    so lookup costs O(route depth) regardless of number of routes
+    """
+
+    class _Node:
+
+        def __init__(self):
+            self.children = {}
+            self.wildcard = None
+
+    def __init__(self):
+        self.__exact = {}
+        self.__wildcards = {}
+        self.__root = RouteTrie._Node()
+        self.frozen = False
+
+    def add(self, route_name, route):
+        if self.frozen:
+            raise RuntimeError("Can't add route %s, routes are shared and can't be changed" % route_name)
+        segments = route_name.split('.')
+        if '*' not in segments:
+            self.__exact[route_name] = route
+            return
+        if segments.index('*') != len(segments) - 1:
+            raise ValueError("Wildcard could be used only as the last segment of route: %s" % route_name)
+        node = self.__root
+        for segment in segments[:-1]:
+            node = node.children.setdefault(segment, RouteTrie._Node())
+        node.wildcard = route
+        self.__wildcards[route_name] = route
+
+    def find(self, route_name):
+        route = self.__exact.get(route_name)
+        if route is not None or not self.__wildcards:
+            return route
+        node = self.__root
+        for segment in route_name.split('.'):
+            if node.wildcard is not None:
+                route = node.wildcard
+            node = node.children.get(segment)
+            if node is None:
+                break
+        return route
+
+    def names(self):
+        return list(self.__exact.keys()) + list(self.__wildcards.keys())
+
+
+class RouteTable:
+    """
+    Handlers and renderers of flow, frozen table could be shared between flows
+    """
+
+    def __init__(self):
+        self.handlers = RouteTrie()
+        self.renders = RouteTrie()
+        self.lazy = {}
+
+    def freeze(self):
+        self.handlers.frozen = True
+        self.renders.frozen = True
+
+
 class Flow(object):
 
-    def __init__(self, fallback=None):
-        self.__handlers = {}
-        self.__renders = {}
+    def __init__(self, fallback=None, routes: RouteTable = None, timeout=None, breaker_threshold=None,
+                 breaker_reset_timeout=30, route_deadline_workers=None):
+        """
+            :timeout is deadline in seconds for every route (conditions and action), it could be overridden by route.
+            Timed out route goes to fallback with RouteTimeout. Sync routes with deadline run in thread pool
+            shared by all flows (see DEADLINE_WORKERS), so they don't see thread locals of calling thread.
+            Every route holds at most :route_deadline_workers threads of the pool (DEADLINE_ROUTE_WORKERS by default),
+            route which can't get a thread in time goes to fallback with RouteNotStarted
+            :breaker_threshold is number of route failures in a row after which route is not called
+            and goes straight to fallback with CircuitOpen, after :breaker_reset_timeout seconds
+            single call is allowed to probe the route
+        """
+        self.timeout = timeout
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.__breakers = {}
+        self.route_deadline_workers = route_deadline_workers or DEADLINE_ROUTE_WORKERS
+        self.__deadline_slots = {}
+        self.__routes = routes if routes is not None else RouteTable()
+        self.__handlers = self.__routes.handlers
+        self.__renders = self.__routes.renders
         self.__fallback = fallback if fallback else default_fallback
+        self.__middlewares = []
+        self.__turns = {}
+        self.__lazy = self.__routes.lazy
 
-    def __route(self, route_name, location, payload=None, ctx=None):
-        payload = payload if payload else {}
-        ctx = ctx if ctx else {}
+    @property
+    def routes(self) -> RouteTable:
+        return self.__routes
+
+    @property
+    def middlewares(self) -> tuple:
+        return tuple(self.__middlewares)
+
+    def use(self, middleware):
+        """
+            Add middleware (see knosk.core.middleware.Middleware) which wraps every route call
+        """
+        self.__middlewares.append(middleware)
+        return middleware
+
+    @contextlib.contextmanager
+    def turn(self, ctx):
+        """
+            Memoize conditions while handling one turn of dialog with :ctx:
+            with flow.turn(ctx):
+                flow.handle("booking", payload, ctx)
+                flow.render("booking", payload, ctx)
+            Every condition is called once per payload object during the turn, even if it's used by several routes,
+            so conditions shared between routes should not depend on route name
+        """
+        key = id(ctx)
+        if key in self.__turns:
+            yield
+            return
+        self.__turns[key] = (ctx, {})
         try:
-            if route_name in location:
-                action = location[route_name]['action']
-                conditions = location[route_name]['conditions']
+            yield
+        finally:
+            del self.__turns[key]
+
+    def __turn_memo(self, ctx):
+        turn = self.__turns.get(id(ctx)) if self.__turns else None
+        if turn is not None and turn[0] is ctx:
+            return turn[1]
+        return None
+
+    def __check(self, memo, condition, route_name, payload, ctx):
+        if memo is None:
+            return condition(self, route_name, payload, ctx)
+        key = _memo_key(condition, payload)
+        memoized = memo.get(key)
+        if memoized is not None and (memoized[0] is payload or not payload):
+            return memoized[1]
+        result = condition(self, route_name, payload, ctx)
+        memo[key] = (payload, result)  # payload is kept so its id is not reused during the turn
+        return result
+
+    async def __check_async(self, memo, condition, route_name, payload, ctx):
+        if memo is None:
+            return await maybe_await(condition(self, route_name, payload, ctx))
+        key = _memo_key(condition, payload)
+        memoized = memo.get(key)
+        if memoized is not None and (memoized[0] is payload or not payload):
+            return memoized[1]
+        result = await maybe_await(condition(self, route_name, payload, ctx))
+        memo[key] = (payload, result)
+        return result
+
+    def __breaker(self, kind, route):
+        """
+            Get circuit breaker of route, raise CircuitOpen if route should not be called
+        """
+        if not self.breaker_threshold:
+            return None
+        key = (kind, route['name'])
+        breaker = self.__breakers.get(key)
+        if breaker is None:
+            breaker = self.__breakers.setdefault(
+                key, CircuitBreaker(self.breaker_threshold, self.breaker_reset_timeout))
+        if not breaker.allow():
+            raise CircuitOpen("Circuit of route %s is open" % route['name'])
+        return breaker
+
+    def __slots(self, kind, route):
+        """
+            Semaphore which limits number of deadline threads held by route
+        """
+        key = (kind, route['name'])
+        slots = self.__deadline_slots.get(key)
+        if slots is None:
+            slots = self.__deadline_slots.setdefault(key, threading.BoundedSemaphore(self.route_deadline_workers))
+        return slots
+
+    def __run(self, route_name, route, payload, ctx, memo, call):
+        for condition in route['conditions']:
+            result = self.__check(memo, condition, route_name, payload, ctx)
+            if result:
+                if call:
+                    call.short_circuited = condition
+                return result
+        return route['action'](self, route_name, payload, ctx)
 
-                for condition in conditions:
-                    result = condition(self, route_name, payload, ctx)
-                    if result:
-                        return result
+    async def __run_async(self, route_name, route, payload, ctx, memo, call):
+        for condition in route['conditions']:
+            result = await self.__check_async(memo, condition, route_name, payload, ctx)
+            if result:
+                if call:
+                    call.short_circuited = condition
+                return result
+        return await maybe_await(route['action'](self, route_name, payload, ctx))
 
-                return action(self, route_name, payload, ctx)
+    def __route(self, route_name, kind, location, payload=None, ctx=None):
+        memo = self.__turn_memo(ctx)
+        payload = payload if payload else {}
+        ctx = ctx if ctx or memo is not None else {}  # turn ctx is kept even if it's empty
+        middlewares = self.__middlewares
+        call = RouteCall(route_name, kind, payload, ctx) if middlewares else None
+        try:
+            for middleware in middlewares:
+                middleware.before(call)
+            route = location.find(route_name)
+            if route is not None:
+                breaker = self.__breaker(kind, route)
+                timeout = route['timeout'] if route.get('timeout') is not None else self.timeout
+                try:
+                    if timeout:
+                        result = _call_with_timeout(timeout, self.__slots(kind, route), self.__run,
+                                                    route_name, route, payload, ctx, memo, call)
+                    else:
+                        result = self.__run(route_name, route, payload, ctx, memo, call)
+                except RouteNotStarted:
+                    if breaker:
+                        breaker.release()
+                    raise
+                except Exception:
+                    if breaker:
+                        breaker.failure()
+                    raise
+                except BaseException:
+                    if breaker:
+                        breaker.release()
+                    raise
+                if breaker:
+                    breaker.success()
+                for middleware in reversed(middlewares):
+                    middleware.after(call, result)
+                return result
             raise ValueError("Can't find route: %s" % route_name)
         except Exception as ex:
+            for middleware in reversed(middlewares):
+                middleware.error(call, ex)
             return self.__fallback(ex, route_name, payload, ctx)
 
+    async def __route_async(self, route_name, kind, location, payload=None, ctx=None):
+        memo = self.__turn_memo(ctx)
+        payload = payload if payload else {}
+        ctx = ctx if ctx or memo is not None else {}  # turn ctx is kept even if it's empty
+        middlewares = self.__middlewares
+        call = RouteCall(route_name, kind, payload, ctx) if middlewares else None
+        try:
+            for middleware in middlewares:
+                await maybe_await(middleware.before(call))
+            route = location.find(route_name)
+            if route is not None:
+                breaker = self.__breaker(kind, route)
+                timeout = route['timeout'] if route.get('timeout') is not None else self.timeout
+                try:
+                    if timeout:
+                        try:
+                            result = await asyncio.wait_for(
+                                self.__run_async(route_name, route, payload, ctx, memo, call), timeout)
+                        except asyncio.TimeoutError:
+                            raise RouteTimeout("Route %s is not handled in %s seconds" % (route_name, timeout))
+                    else:
+                        result = await self.__run_async(route_name, route, payload, ctx, memo, call)
+                except Exception:
+                    if breaker:
+                        breaker.failure()
+                    raise
+                except BaseException:
+                    if breaker:
+                        breaker.release()
+                    raise
+                if breaker:
+                    breaker.success()
+                for middleware in reversed(middlewares):
+                    await maybe_await(middleware.after(call, result))
+                return result
+            raise ValueError("Can't find route: %s" % route_name)
+        except Exception as ex:
+            for middleware in reversed(middlewares):
+                await maybe_await(middleware.error(call, ex))
+            return await maybe_await(self.__fallback(ex, route_name, payload, ctx))
+
     def handle(self, route_name, payload=None, ctx=None):
-        return self.__route(route_name, self.__handlers, payload, ctx)
+        return self.__route(route_name, 'handler', self.__handlers, payload, ctx)
 
     def render(self, route_name, payload=None, ctx=None):
-        return self.__route(route_name, self.__renders, payload, ctx)
+        return self.__route(route_name, 'renderer', self.__renders, payload, ctx)
+
+    def handle_batch(self, items, executor=None, max_workers=None, max_pending=256):
+        """
+            Handle batch of (conversation_id, route_name, payload, ctx) turns on thread pool.
+            Turns of one conversation are handled strictly one by one in order of :items,
+            different conversations are handled in parallel.
+            Returns iterator of TurnResult in order of completion, error is exception raised from handle (e.g. by
+            fallback) or None. :items could be endless iterator, at most :max_pending turns are taken from it
+            until their results are consumed. Pool is created for the batch unless :executor is passed
+        """
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers)
+        items = iter(items)
+        waiting = {}  # conversation_id -> turns waiting for the running turn of the same conversation
+        running = {}
+        pending = 0
+        exhausted = False
+
+        def submit(item):
+            conversation_id, route_name, payload, ctx = item
+            running[executor.submit(self.handle, route_name, payload, ctx)] = item
+
+        try:
+            while True:
+                while not exhausted and pending < max_pending:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending += 1
+                    if item[0] in waiting:
+                        waiting[item[0]].append(item)
+                    else:
+                        waiting[item[0]] = deque()
+                        submit(item)
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    conversation_id, route_name, payload, ctx = running.pop(future)
+                    pending -= 1
+                    if waiting[conversation_id]:
+                        submit(waiting[conversation_id].popleft())
+                    else:
+                        del waiting[conversation_id]
+                    error = future.exception()
+                    yield TurnResult(conversation_id, route_name, None if error else future.result(), error)
+        finally:
+            if own_executor:
+                executor.shutdown(wait=True)
 
-    def __register(self, route_name, location, conditions: list = []):
+    async def handle_async(self, route_name, payload=None, ctx=None):
+        """
+            Async version of handle, conditions, actions and fallback could be coroutine functions
+        """
+        return await self.__route_async(route_name, 'handler', self.__handlers, payload, ctx)
+
+    async def render_async(self, route_name, payload=None, ctx=None):
+        """
+            Async version of render, conditions, actions and fallback could be coroutine functions
+        """
+        return await self.__route_async(route_name, 'renderer', self.__renders, payload, ctx)
+
+    def __register(self, route_name, location, conditions: list = [], timeout=None):
         def decorator(func):
-            location[route_name] = {'action': func, 'conditions': conditions}
+            location.add(route_name, {'name': route_name, 'action': func, 'conditions': conditions,
+                                      'timeout': timeout})
             return func
 
         return decorator
 
-    def handler(self, route_name, conditions: list = []):
-        return self.__register(route_name, self.__handlers, conditions)
+    def handler(self, route_name, conditions: list = [], timeout=None):
+        """
+            Register handler for route, route name could end with wildcard e.g. booking.*
+            :timeout overrides deadline of flow for this route
+        """
+        return self.__register(route_name, self.__handlers, conditions, timeout)
+
+    def renderer(self, route_name, conditions: list = [], timeout=None):
+        return self.__register(route_name, self.__renders, conditions, timeout)
+
+    def __lazy_callable(self, func):
+        if not isinstance(func, str):
+            return func
+        lazy = self.__lazy.get(func)
+        if lazy is None:
+            lazy = self.__lazy.setdefault(func, _LazyCallable(func))
+        return lazy
+
+    def __register_lazy(self, route_name, location, action, conditions, timeout):
+        conditions = [self.__lazy_callable(condition) for condition in conditions]
+        self.__register(route_name, location, conditions, timeout)(self.__lazy_callable(action))
 
-    def renderer(self, route_name, conditions: list = []):
-        return self.__register(route_name, self.__renders, conditions)
+    def register_handler(self, route_name, action, conditions: list = [], timeout=None):
+        """
+            Register handler without importing it, :action and :conditions could be "package.module:function"
+            paths which are imported on first dispatch of the route
+        """
+        self.__register_lazy(route_name, self.__handlers, action, conditions, timeout)
+
+    def register_renderer(self, route_name, action, conditions: list = [], timeout=None):
+        """
+            Register renderer without importing it, see register_handler
+        """
+        self.__register_lazy(route_name, self.__renders, action, conditions, timeout)
+
+    def warm_up(self):
+        """
+            Import all lazily registered handlers, renderers and conditions
+        """
+        for lazy in list(self.__lazy.values()):
+            lazy.resolve()
+        return len(self.__lazy)
 
     def handler_names(self):
-        return list(self.__handlers.keys())
+        return self.__handlers.names()
+
+
+class FlowRegistry:
+    """
+    Thread-safe registry of flows of many bots.
+    Bot is registered with definition - function which registers routes of passed flow,
+    flow is built on first get. Bots registered with the same definition share one frozen route table,
+    so definition must register routes only. Flow level setup (middleware, timeout, circuit breaker) is done
+    by :configure function which is called for every built flow of the bot.
+    Least recently used flows are evicted when there are more than :max_flows of them
+    or when they were not used for :idle_ttl seconds, evicted flow is rebuilt on next get
+    """
+
+    def __init__(self, max_flows=None, idle_ttl=None):
+        self.max_flows = max_flows
+        self.idle_ttl = idle_ttl
+        self.__definitions = {}
+        self.__flows = OrderedDict()
+        self.__building = {}
+        self.__tables = weakref.WeakValueDictionary()
+        self.__table_locks = weakref.WeakKeyDictionary()
+        self.__lock = threading.Lock()
+
+    def register(self, bot_id, definition, fallback=None, configure=None):
+        with self.__lock:
+            self.__definitions[bot_id] = (definition, fallback, configure)
+            self.__flows.pop(bot_id, None)
+            self.__building.pop(bot_id, None)
+
+    def unregister(self, bot_id):
+        with self.__lock:
+            self.__definitions.pop(bot_id, None)
+            self.__flows.pop(bot_id, None)
+            self.__building.pop(bot_id, None)
+
+    def get(self, bot_id) -> Flow:
+        """
+            Get flow of bot, flow is built outside of registry lock so slow definition of one bot
+            doesn't block other bots, concurrent gets of the same bot wait for single build
+        """
+        with self.__lock:
+            now = time.monotonic()
+            entry = self.__flows.get(bot_id)
+            if entry is not None:
+                entry[1] = now
+                self.__flows.move_to_end(bot_id)
+                self.__evict(now)
+                return entry[0]
+
+            if bot_id not in self.__definitions:
+                raise KeyError("Bot %s is not registered" % bot_id)
+            building = self.__building.get(bot_id)
+            if building is not None:
+                owner = False
+            else:
+                owner = True
+                building = self.__building[bot_id] = concurrent.futures.Future()
+                definition, fallback, configure = self.__definitions[bot_id]
+                table_lock = self.__table_locks.get(definition)
+                if table_lock is None:
+                    table_lock = self.__table_locks[definition] = threading.Lock()
+        if not owner:
+            return building.result()
+
+        try:
+            flow = Flow(fallback, routes=self.__build_routes(bot_id, definition, table_lock))
+            if configure is not None:
+                configure(flow)
+        except BaseException as ex:
+            with self.__lock:
+                if self.__building.get(bot_id) is building:
+                    del self.__building[bot_id]
+            building.set_exception(ex)
+            raise
+        with self.__lock:
+            if self.__building.get(bot_id) is building:  # bot was not registered again while building
+                del self.__building[bot_id]
+                now = time.monotonic()
+                self.__flows[bot_id] = [flow, now]
+                self.__evict(now)
+        building.set_result(flow)
+        return flow
+
+    def __build_routes(self, bot_id, definition, table_lock) -> RouteTable:
+        with table_lock:
+            routes = self.__tables.get(definition)
+            if routes is not None:
+                return routes
+            LOG.info("Build routes for bot %s" % bot_id)
+            flow = Flow()
+            definition(flow)
+            if flow.middlewares or flow.timeout is not None or flow.breaker_threshold:
+                raise ValueError("Definition of bot %s changes flow settings, which are not shared with "
+                                 "other flows, use configure instead" % bot_id)
+            flow.routes.freeze()
+            self.__tables[definition] = flow.routes
+            return flow.routes
+
+    def __evict(self, now):
+        while self.max_flows is not None and len(self.__flows) > self.max_flows:
+            bot_id, _ = self.__flows.popitem(last=False)
+            LOG.info("Flow of bot %s evicted" % bot_id)
+        while self.idle_ttl is not None and self.__flows:
+            bot_id, (flow, last_used) = next(iter(self.__flows.items()))
+            if now - last_used <= self.idle_ttl:
+                break
+            del self.__flows[bot_id]
+            LOG.info("Idle flow of bot %s evicted" % bot_id)
+
+    def __contains__(self, bot_id):
+        return bot_id in self.__flows
+
+    def __len__(self):
+        return len(self.__flows)
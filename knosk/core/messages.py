@@ -273,6 +273,9 @@ class MessageBox(ChannelMessage):
 
     @classmethod
     def from_text_to_message(cls, text):
+        if not text.lstrip().startswith('{'):
+            # only json object could be a message box, so don't try to parse plain text
+            return cls.from_text(text)
         try:
             data = json.loads(text)
             LOG.debug("Parse message data %s" % data)
@@ -0,0 +1,105 @@
+import threading
+import time
+from knosk.core.stats import LatencyHistogram
+
+
+class RouteCall:
+    """
+    Single route call passed to middleware hooks.
+    kind is handler or renderer, short_circuited is condition which returned result instead of action,
+    data could be used by middleware to keep its own state between hooks
+    """
+
+    def __init__(self, route_name, kind, payload, ctx):
+        self.route_name = route_name
+        self.kind = kind
+        self.payload = payload
+        self.ctx = ctx
+        self.short_circuited = None
+        self.started = time.perf_counter()
+        self.data = {}
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+class Middleware:
+    """
+    Flow middleware, before hooks are called in order of registration,
+    after and error hooks are called in reverse order.
+    error is called before fallback, exception raised from before hook is handled as route error
+    """
+
+    def before(self, call: RouteCall):
+        pass
+
+    def after(self, call: RouteCall, result):
+        pass
+
+    def error(self, call: RouteCall, ex: Exception):
+        pass
+
+
+class RouteMetrics:
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.short_circuits = 0
+        self.latency = LatencyHistogram()
+
+
+class MetricsMiddleware(Middleware):
+    """
+    Collect per route calls, errors, condition short-circuits and latency
+    """
+
+    def __init__(self):
+        self.__routes = {}
+        self.__lock = threading.Lock()
+
+    def __record(self, call, error=False):
+        elapsed = call.elapsed
+        with self.__lock:
+            metrics = self.__routes.get((call.kind, call.route_name))
+            if metrics is None:
+                metrics = self.__routes[(call.kind, call.route_name)] = RouteMetrics()
+            metrics.calls += 1
+            metrics.errors += 1 if error else 0
+            metrics.short_circuits += 1 if call.short_circuited is not None else 0
+            metrics.latency.record(elapsed)
+
+    def after(self, call, result):
+        self.__record(call)
+
+    def error(self, call, ex):
+        self.__record(call, error=True)
+
+    def get(self, route_name, kind='handler') -> RouteMetrics:
+        return self.__routes.get((kind, route_name))
+
+    def routes(self) -> list:
+        """
+            (kind, route name) of called routes, the slowest go first
+        """
+        with self.__lock:
+            return sorted(self.__routes, key=lambda key: self.__routes[key].latency.total, reverse=True)
+
+    def reset(self):
+        with self.__lock:
+            self.__routes = {}
+
+    def dump(self) -> str:
+        """
+            Text report, times are in milliseconds
+        """
+        lines = ["%-9s %-40s %8s %7s %7s %9s %9s %9s %9s" % (
+            'kind', 'route', 'calls', 'errors', 'shorts', 'mean', 'p50', 'p95', 'p99')]
+        for kind, route_name in self.routes():
+            metrics = self.__routes[(kind, route_name)]
+            latency = metrics.latency
+            lines.append("%-9s %-40s %8d %7d %7d %9.3f %9.3f %9.3f %9.3f" % (
+                kind, route_name, metrics.calls, metrics.errors, metrics.short_circuits, latency.mean * 1000,
+                latency.percentile(50) * 1000, latency.percentile(95) * 1000, latency.percentile(99) * 1000))
+        return '\n'.join(lines)
@@ -0,0 +1,45 @@
+"""
+    Compile templates ahead of time so new processes start with warm bytecode cache
+
+    $ knosk-precompile /path/to/app /path/to/cache --location templates
+"""
+import argparse
+import importlib
+import sys
+from knosk.core.render import TemplateRenderer
+
+
+def _import_object(dotted_path):
+    module_name, attr_name = dotted_path.split(':', 1)
+    return getattr(importlib.import_module(module_name), attr_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='knosk-precompile',
+                                     description='Compile knosk templates to bytecode cache')
+    parser.add_argument('app_path', help='application folder which is passed to TemplateRenderer')
+    parser.add_argument('cache_dir', help='folder for compiled templates')
+    parser.add_argument('--location', action='append', dest='locations',
+                        help='tmpl_location to compile, could be passed several times (default: templates)')
+    parser.add_argument('--filters', help='dict of template filters as package.module:name, '
+                                          'filters are required to compile templates using them')
+    parser.add_argument('--no-async', action='store_false', dest='async_mode',
+                        help="don't compile templates for render_async")
+    args = parser.parse_args(argv)
+
+    tmpl_filters = _import_object(args.filters) if args.filters else None
+    renderer = TemplateRenderer(args.app_path, tmpl_filters=tmpl_filters, bytecode_cache_dir=args.cache_dir)
+    failed = []
+
+    def on_error(template_path, ex):
+        failed.append(template_path)
+        print("Can't compile template %s: %s" % (template_path, ex), file=sys.stderr)
+
+    for tmpl_location in args.locations or ['templates']:
+        compiled = renderer.precompile(tmpl_location, on_error=on_error, async_mode=args.async_mode)
+        print("Compiled %s templates from %s" % (compiled, tmpl_location))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,409 @@
 import os
+import asyncio
+import collections
+import functools
+import itertools
 import logging
-import random
+import re
+import threading
+import time
 import jinja2
+from jinja2.ext import Extension
+from jinja2 import nodes
+from knosk.core.bundle import TemplateBundle
+from knosk.core.cache import LRUCache
+from knosk.core.messages import MessageBox
+from knosk.core.variants import UniformSelector
 LOG = logging.getLogger(__name__)
 
+# templates which starts with {# cacheable #} comment are rendered once for the same kwargs
+CACHEABLE_MARK = re.compile(r'\s*\{#-?\s*cacheable\s*-?#\}')
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+_FROZEN_SCALARS = (str, bytes, int, float, bool, type(None))
+
+
+def _freeze(value):
+    """
+        Convert kwargs to hashable value, raise TypeError if it's impossible.
+        Only scalars of known immutable types and containers of them are frozen, containers are frozen by content.
+        Other objects (e.g. models) may hash by identity and change after rendering, so they are not cacheable.
+        Every value is tagged with its type since e.g. 1, 1.0 and True are equal but render differently
+    """
+    value_type = type(value)
+    if value_type in _FROZEN_SCALARS:
+        return value_type, value
+    if value_type is dict:
+        return dict, frozenset((_freeze(key), _freeze(val)) for key, val in value.items())
+    if value_type in (list, tuple):
+        return value_type, tuple(_freeze(val) for val in value)
+    if value_type in (set, frozenset):
+        return value_type, frozenset(_freeze(val) for val in value)
+    raise TypeError("Value of type %s can't be frozen" % value_type.__name__)
+
+
+class FragmentCacheExtension(Extension):
+    """
+        Cache rendered part of template:
+        {% cache "price_list_" ~ organization_id, 300 %}...{% endcache %}
+        Key is shared between all templates of renderer, ttl is in seconds and could be omitted.
+        Fragments are stored in environment.fragment_cache, any object with get(key) and set(key, value, ttl)
+        could be used as store, LRUCache is used by default
+    """
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=LRUCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', args), [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, key, ttl, caller):
+        if self.environment.is_async:
+            return self._cache_support_async(key, ttl, caller)
+        fragment = self.environment.fragment_cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            self.environment.fragment_cache.set(key, fragment, ttl)
+        return fragment
+
+    async def _cache_support_async(self, key, ttl, caller):
+        fragment = self.environment.fragment_cache.get(key)
+        if fragment is None:
+            fragment = await caller()
+            self.environment.fragment_cache.set(key, fragment, ttl)
+        return fragment
+
+
+class _TemplateLoader(jinja2.BaseLoader):
+    """
+        Base loader which remembers templates marked as cacheable.
+        local.loaded flag is set in the thread which loaded template source
+    """
+
+    def __init__(self):
+        self.cacheable = set()
+        self.local = threading.local()
+
+    def _loaded(self, template, tmpl_content):
+        self.local.loaded = True
+        if CACHEABLE_MARK.match(tmpl_content):
+            self.cacheable.add(template)
+        else:
+            self.cacheable.discard(template)
+        return tmpl_content
+
+
+class _TemplateFileLoader(_TemplateLoader):
+    """
+        Load template by its resolved file path.
+        Template is considered up to date while mtime of the file is unchanged
+    """
+
+    def get_source(self, environment, template):
+        mtime = _get_mtime(template)
+        with open(template, 'r') as tfile:
+            tmpl_content = tfile.read()
+
+        def uptodate():
+            return mtime is not None and _get_mtime(template) == mtime
+
+        return self._loaded(template, tmpl_content), template, uptodate
+
+
+class _TemplateBundleLoader(_TemplateLoader):
+    """
+        Load template by its resolved file path from templates bundle.
+        Template is considered up to date until bundle is reopened
+    """
+
+    def __init__(self, bundle, app_path):
+        super(_TemplateBundleLoader, self).__init__()
+        self.bundle = bundle
+        self.__app_path = app_path
+
+    def get_source(self, environment, template):
+        bundle = self.bundle
+        bundle_path = os.path.relpath(template, self.__app_path)
+        if bundle_path not in bundle:
+            raise jinja2.TemplateNotFound(template)
+        tmpl_content = self._loaded(template, bundle.get_source(bundle_path))
+        return tmpl_content, template, lambda: self.bundle is bundle
+
+
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+        Persistent cache of compiled templates.
+        Templates are keyed by path relative to application folder, so cache built on one machine
+        (e.g. while building image) is valid for the application deployed to another folder
+    """
+
+    def __init__(self, directory, app_path, async_mode=False):
+        super(TemplateBytecodeCache, self).__init__(directory)
+        self.__app_path = os.path.abspath(app_path)
+        self.__prefix = 'async:' if async_mode else ''  # templates compiled for async rendering differ
+
+    def get_cache_key(self, name, filename=None):
+        return super(TemplateBytecodeCache, self).get_cache_key(
+            self.__prefix + os.path.relpath(os.path.abspath(name), self.__app_path))
+
+
+class _NegativeCache:
+    """
+        Remember paths which don't exist for :ttl seconds
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__expires = {}
+
+    def __contains__(self, key):
+        expires = self.__expires.get(key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            self.__expires.pop(key, None)
+            return False
+        return True
+
+    def add(self, key):
+        if len(self.__expires) >= self.__max_size:
+            now = time.monotonic()
+            self.__expires = {k: expires for k, expires in self.__expires.items() if expires >= now}
+            if len(self.__expires) >= self.__max_size:
+                self.__expires = {}
+        self.__expires[key] = time.monotonic() + self.__ttl
+
+    def clear(self):
+        self.__expires = {}
+
+
+class TemplateIndex:
+    """
+        In-memory index of templates tree.
+        Maps folder path relative to templates folder (e.g. organizations/1/ru_RU/text/booking/ask)
+        to template folder and sorted paths of its templates
+    """
+
+    def __init__(self, templates_folder, walk=os.walk):
+        self.__templates_folder = templates_folder
+        self.__walk = walk
+        self.__folders = {}
+        self.rescan()
+
+    @property
+    def templates_folder(self):
+        return self.__templates_folder
+
+    def rescan(self, walk=None):
+        """
+            Walk templates tree and rebuild index, new index replaces old one at once
+            so it's safe to rescan while other threads are rendering.
+            :walk is function with os.walk interface used to walk the tree
+        """
+        if walk is not None:
+            self.__walk = walk
+        folders = {}
+        for dir_path, dir_names, file_names in self.__walk(self.__templates_folder):
+            key = os.path.normpath(os.path.relpath(dir_path, self.__templates_folder))
+            folders[key] = (dir_path, tuple(os.path.join(dir_path, name) for name in sorted(file_names)
+                                            if name.endswith('.tmpl')))
+        self.__folders = folders
+        LOG.info("Indexed %s template folders in %s" % (len(folders), self.__templates_folder))
+
+    def find(self, locale_name, tmpl_type, tmpl_name, default_tmpl_type, tmpl_custom_folders):
+        """
+            Find template folder with the same priorities as filesystem lookup does,
+            returns tuple (folder, template paths) or None
+        """
+        folders = self.__folders
+        template_location = os.path.join(locale_name, tmpl_type, tmpl_name)
+        candidates = [os.path.normpath(os.path.join(tmpl_folder, template_location))
+                      for tmpl_folder in tmpl_custom_folders]
+        candidates = [key for key in candidates if key in folders][:1]
+        candidates.append(os.path.normpath(template_location))
+        candidates.append(os.path.normpath(os.path.join(locale_name, default_tmpl_type, tmpl_name)))
+        for key in candidates:
+            if key in folders:
+                return folders[key]
+        return None
+
 
 class TemplateRenderer:
 
-    def __init__(self, app_path, tmpl_globals=None, tmpl_filters=None, default_tmpl_type='text'):
+    def __init__(self, app_path, tmpl_globals=None, tmpl_filters=None, default_tmpl_type='text', cache_size=400,
+                 indexed_locations=None, negative_cache_ttl=None, bytecode_cache_dir=None, bundle_path=None,
+                 variant_selector=None, result_cache_size=None, message_cls=MessageBox, message_cache_size=None,
+                 stats=None, fragment_cache=None):
+        """
+            :cache_size is max number of compiled templates kept in memory,
+            0 disables caching and -1 makes the cache unbounded
+            :indexed_locations is list of tmpl_location folders which are indexed once on start,
+            templates from these locations are resolved from memory without touching filesystem.
+            Call rescan_templates after templates deploy to pick up new templates
+            :negative_cache_ttl is number of seconds to remember that template folder doesn't exist
+            for not indexed locations (e.g. organization has no override for the template),
+            it's disabled by default
+            :bytecode_cache_dir is folder with compiled templates (see knosk-precompile),
+            templates are compiled once and loaded from this folder by new processes
+            :bundle_path is templates bundle (see knosk-bundle) which is used instead of templates folders,
+            all locations are indexed from the bundle and templates are read from memory-mapped file.
+            Call rescan_templates to reopen the bundle after it was rebuilt
+            :variant_selector is strategy how to pick template from the folder (see knosk.core.variants),
+            templates are picked randomly by default
+            :result_cache_size is max number of rendered strings remembered for templates
+            which starts with {# cacheable #} comment, rendered string is reused for the same template
+            and kwargs. Template is picked before cache lookup, so every variant is cached separately
+            :message_cls is MessageBox class which is used by render_message
+            :message_cache_size is max number of messages parsed by render_message which are remembered
+            by rendered text, cached messages are shared between calls so they should not be modified
+            :stats is knosk.core.stats.RenderStats which collects timings of resolve, load and render phases
+            of every template, it's disabled by default
+            :fragment_cache is store for {% cache %} blocks (see FragmentCacheExtension), LRUCache by default
+        """
         self.__path = app_path
         self._tmpl_globals = tmpl_globals if tmpl_globals is not None else {}
         self._tmpl_filters = tmpl_filters if tmpl_filters is not None else {}
         self.default_tmpl_type = default_tmpl_type
+        self.variant_selector = variant_selector if variant_selector is not None else UniformSelector()
+        self.result_cache = LRUCache(result_cache_size) if result_cache_size else None
+        self.message_cls = message_cls
+        self.message_cache = LRUCache(message_cache_size) if message_cache_size else None
+        self.stats = stats
+        self.fragment_cache = fragment_cache if fragment_cache is not None else LRUCache()
+        self.__bundle_path = bundle_path
+        if bundle_path:
+            bundle = TemplateBundle(bundle_path)
+            self.__loader = _TemplateBundleLoader(bundle, app_path)
+            self._walk = functools.partial(bundle.walk, root=app_path)
+        else:
+            self.__loader = _TemplateFileLoader()
+            self._walk = os.walk
+        bytecode_cache = TemplateBytecodeCache(bytecode_cache_dir, app_path) if bytecode_cache_dir else None
+        async_bytecode_cache = TemplateBytecodeCache(bytecode_cache_dir, app_path, async_mode=True)\
+            if bytecode_cache_dir else None
+        self.__env = self._create_environment(cache_size=cache_size, bytecode_cache=bytecode_cache)
+        self.__async_env = self._create_environment(cache_size=cache_size, bytecode_cache=async_bytecode_cache,
+                                                    enable_async=True)
+        self.__indexes = {tmpl_location: TemplateIndex(os.path.join(self.__path, tmpl_location), self._walk)
+                          for tmpl_location in (indexed_locations or [])}
+        self.__missing = _NegativeCache(negative_cache_ttl) if negative_cache_ttl else None
 
-    def _get_template_path(self, tmpl_name:str, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders) -> str:
+    def rescan_templates(self):
+        """
+            Rebuild index of templates tree for all indexed locations and forget missing templates
+        """
+        if self.__bundle_path:
+            bundle = TemplateBundle(self.__bundle_path)
+            self._walk = functools.partial(bundle.walk, root=self.__path)
+            self.__loader.bundle = bundle
+            LOG.info("Templates bundle %s reopened" % self.__bundle_path)
+        for index in list(self.__indexes.values()):
+            index.rescan(self._walk)
+        if self.__missing is not None:
+            self.__missing.clear()
+
+    def precompile(self, tmpl_location='templates', on_error=None, async_mode=True) -> int:
+        """
+            Compile all templates of :tmpl_location, compiled templates are stored to bytecode cache
+            if renderer has one. When :on_error is passed it's called with template path and exception
+            instead of raising. Returns number of compiled templates.
+            Templates are compiled for render_async as well unless :async_mode is False
+        """
+        envs = (self.__env, self.__async_env) if async_mode else (self.__env,)
+        compiled = 0
+        for dir_path, dir_names, file_names in self._walk(os.path.join(self.__path, tmpl_location)):
+            for file_name in sorted(file_names):
+                if not file_name.endswith('.tmpl'):
+                    continue
+                template_path = os.path.join(dir_path, file_name)
+                try:
+                    for env in envs:
+                        env.get_template(template_path)
+                    compiled += 1
+                except Exception as ex:
+                    if on_error is None:
+                        raise
+                    on_error(template_path, ex)
+        return compiled
+
+    def _isdir(self, path) -> bool:
+        if self.__missing is None:
+            return os.path.isdir(path)
+        if path in self.__missing:
+            return False
+        if os.path.isdir(path):
+            return True
+        self.__missing.add(path)
+        return False
+
+    def _create_environment(self, **options) -> jinja2.Environment:
+        """
+            Create long-lived environment, compiled templates are cached by environment
+            and reloaded as soon as template file was modified
+        """
+        env = jinja2.Environment(loader=self.__loader, auto_reload=True, extensions=[FragmentCacheExtension],
+                                 **options)
+        env.fragment_cache = self.fragment_cache
+        env.globals.update(self._tmpl_globals)
+        env.filters.update(self._tmpl_filters)
+        return env
+
+    def _get_template_path(self, tmpl_name:str, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders,
+                           variant_key=None) -> str:
         """
             Find appropriate template
         """
+        return self.variant_selector(self._get_template_variants(
+            tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders), variant_key)
+
+    def _get_template_variants(self, tmpl_name:str, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders):
+        """
+            Find folder with appropriate templates and return sorted paths of all templates from it
+        """
+        if self.__bundle_path and tmpl_location not in self.__indexes:
+            self.__indexes[tmpl_location] = TemplateIndex(os.path.join(self.__path, tmpl_location), self._walk)
+        if tmpl_location in self.__indexes:
+            full_path_to_templates, template_paths = self._find_indexed_templates(
+                tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders)
+        else:
+            full_path_to_templates, template_paths = self._find_templates(
+                tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders)
+        if not template_paths:
+            raise ValueError("Folder with templates %s is empty" % full_path_to_templates)
+        return template_paths
+
+    def _find_indexed_templates(self, tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders):
+        index = self.__indexes[tmpl_location]
+        found = index.find(locale_name, tmpl_type, tmpl_name, self.default_tmpl_type, tmpl_custom_folders)
+        if not found:
+            raise ValueError("Template %s/%s/%s not found in %s" % (
+                locale_name, tmpl_type, tmpl_name, index.templates_folder))
+        return found
+
+    def _find_templates(self, tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders):
         main_templates_folder = os.path.join(self.__path, tmpl_location)
-        if not os.path.isdir(main_templates_folder):
+        if not self._isdir(main_templates_folder):
             raise ValueError("Template path %s does not exist" % main_templates_folder)
         template_location = os.path.join(locale_name, tmpl_type, tmpl_name)
         default_template_location = os.path.join(locale_name, self.default_tmpl_type, tmpl_name)
-        custom_templates = [tmpl_folder for tmpl_folder in tmpl_custom_folders if os.path.isdir(os.path.join(main_templates_folder, tmpl_folder, template_location))]
+        custom_templates = [tmpl_folder for tmpl_folder in tmpl_custom_folders if self._isdir(os.path.join(main_templates_folder, tmpl_folder, template_location))]
 
         full_templates_path = [] 
         if custom_templates:
@@ -30,7 +411,7 @@ class TemplateRenderer:
         full_templates_path.append(os.path.join(main_templates_folder, template_location))
         full_templates_path.append(os.path.join(main_templates_folder, default_template_location))
 
-        available_templates = [tmpl_path for tmpl_path in full_templates_path if os.path.isdir(tmpl_path)]
+        available_templates = [tmpl_path for tmpl_path in full_templates_path if self._isdir(tmpl_path)]
 
         if not available_templates:
             raise ValueError("Full path template folders %s don't exist" % full_templates_path)
@@ -38,13 +419,34 @@ class TemplateRenderer:
         full_path_to_templates = available_templates[0]
 
         template_names = [tmpl for tmpl in os.listdir(full_path_to_templates) if os.path.isfile(os.path.join(full_path_to_templates, tmpl)) and tmpl.endswith('.tmpl')]
-        if not template_names:
-            raise ValueError("Folder with templates %s is empty" % full_path_to_templates)
+        return full_path_to_templates, tuple(os.path.join(full_path_to_templates, tmpl) for tmpl in sorted(template_names))
+
+    @staticmethod
+    def _with_defaults(tmpl_location, locale_name, tmpl_type):
+        tmpl_location = 'templates' if not tmpl_location else tmpl_location
+        locale_name = 'ru_RU' if not locale_name else locale_name
+        tmpl_type = 'text' if not tmpl_type else tmpl_type
+        return tmpl_location, locale_name, tmpl_type
+
+    def _get_template(self, env, tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders,
+                      variant_key=None):
+        tmpl_location, locale_name, tmpl_type = self._with_defaults(tmpl_location, locale_name, tmpl_type)
+        if self.stats is None:
+            return env.get_template(self._get_template_path(
+                tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders, variant_key))
 
-        template_path = os.path.join(full_path_to_templates, random.choice(template_names))
-        return template_path
+        started = time.perf_counter()
+        template_path = self._get_template_path(tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders,
+                                                variant_key)
+        resolved = time.perf_counter()
+        self.__loader.local.loaded = False
+        tmpl = env.get_template(template_path)
+        self.stats.record(template_path, 'resolve', resolved - started)
+        self.stats.record(template_path, 'load', time.perf_counter() - resolved, not self.__loader.local.loaded)
+        return tmpl
 
-    def render(self, tmpl_name:str, tmpl_location='templates', locale_name='ru_RU', tmpl_type='text', tmpl_custom_folders=[], **kwargs) -> str:
+    def render(self, tmpl_name:str, tmpl_location='templates', locale_name='ru_RU', tmpl_type='text', tmpl_custom_folders=[],
+               tmpl_variant_key=None, **kwargs) -> str:
         """Render results to string using jinja templates
             the idea is the following
             /template - main folder for templates
@@ -65,15 +467,143 @@ class TemplateRenderer:
                                     |_anyothername.tmpl
                                     |_whatevername.tmpl
             so first priority has tmpl_custom_folders then locale_name, then tmpl_type then template name
+            tmpl_variant_key is passed to variant selector, e.g. conversation id for SeededSelector
         """
-        tmpl_location = 'templates' if not tmpl_location else tmpl_location
-        locale_name = 'ru_RU' if not locale_name else locale_name
-        tmpl_type = 'text' if not tmpl_type else tmpl_type
-        template_path = self._get_template_path(tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders)
-        with open(template_path, 'r') as tfile:
-            tmpl_content = tfile.read()
-            env = jinja2.Environment()
-            env.globals.update(self._tmpl_globals)
-            env.filters.update(self._tmpl_filters)
-            tmpl = env.from_string(tmpl_content)
-            return tmpl.render(**kwargs)
+        tmpl = self._get_template(self.__env, tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders,
+                                  tmpl_variant_key)
+        started = time.perf_counter()
+        result_key = self._get_result_key(tmpl, kwargs)
+        result = self.result_cache.get(result_key) if result_key is not None else None
+        cache_hit = result is not None if result_key is not None else None
+        if result is None:
+            result = tmpl.render(**kwargs)
+            if result_key is not None:
+                self.result_cache.set(result_key, result)
+        if self.stats is not None:
+            self.stats.record(tmpl.name, 'render', time.perf_counter() - started, cache_hit)
+        return result
+
+    def _get_result_key(self, tmpl, kwargs):
+        """
+            Key of rendered string in result cache or None if result should not be cached.
+            Key contains template object itself, so reloaded template doesn't reuse old results
+        """
+        if self.result_cache is None or tmpl.name not in self.__loader.cacheable:
+            return None
+        try:
+            return tmpl, _freeze(kwargs)
+        except TypeError:
+            return None
+
+    async def render_async(self, tmpl_name:str, tmpl_location='templates', locale_name='ru_RU', tmpl_type='text',
+                           tmpl_custom_folders=[], tmpl_variant_key=None, **kwargs) -> str:
+        """
+            Async version of render with the same templates resolution.
+            Template lookup and loading are done in default executor so event loop is not blocked,
+            template is rendered in async mode so globals and filters could be coroutines
+        """
+        loop = asyncio.get_event_loop()
+        tmpl = await loop.run_in_executor(None, functools.partial(
+            self._get_template, self.__async_env, tmpl_name, tmpl_location, locale_name, tmpl_type,
+            tmpl_custom_folders, tmpl_variant_key))
+        started = time.perf_counter()
+        result_key = self._get_result_key(tmpl, kwargs)
+        result = self.result_cache.get(result_key) if result_key is not None else None
+        cache_hit = result is not None if result_key is not None else None
+        if result is None:
+            result = await tmpl.render_async(**kwargs)
+            if result_key is not None:
+                self.result_cache.set(result_key, result)
+        if self.stats is not None:
+            self.stats.record(tmpl.name, 'render', time.perf_counter() - started, cache_hit)
+        return result
+
+    def render_message(self, tmpl_name:str, *args, **kwargs) -> MessageBox:
+        """
+            Render template and convert result to message box,
+            templates which render json object become rich messages, others become text message
+        """
+        return self._to_message(self.render(tmpl_name, *args, **kwargs))
+
+    async def render_message_async(self, tmpl_name:str, *args, **kwargs) -> MessageBox:
+        """
+            Async version of render_message
+        """
+        return self._to_message(await self.render_async(tmpl_name, *args, **kwargs))
+
+    def _to_message(self, text) -> MessageBox:
+        if self.message_cache is None:
+            return self.message_cls.from_text_to_message(text)
+        message = self.message_cache.get(text)
+        if message is None:
+            message = self.message_cls.from_text_to_message(text)
+            self.message_cache.set(text, message)
+        return message
+
+    def render_many(self, tmpl_name:str, contexts, tmpl_location='templates', locale_name='ru_RU', tmpl_type='text',
+                    tmpl_custom_folders=[], executor=None, chunksize=100, max_pending=None):
+        """
+            Render the same template for every kwargs dict from :contexts, e.g. for broadcasts.
+            Template folder is resolved and all its templates are compiled once, template is still picked up
+            by variant selector for every context. Returns generator of rendered strings in order of contexts.
+            If :executor is passed (e.g. ProcessPoolExecutor for heavy templates) rendering is spread
+            across its workers by :chunksize contexts, in this case globals, filters and contexts must be picklable.
+            At most :max_pending chunks (twice the number of executor workers by default) are submitted at once,
+            so :contexts are read lazily as results are consumed
+        """
+        tmpl_location, locale_name, tmpl_type = self._with_defaults(tmpl_location, locale_name, tmpl_type)
+        template_paths = self._get_template_variants(
+            tmpl_name, tmpl_location, locale_name, tmpl_type, tmpl_custom_folders)
+        select = self.variant_selector
+        if executor is None:
+            templates = {template_path: self.__env.get_template(template_path) for template_path in template_paths}
+            return (templates[select(template_paths)].render(**kwargs) for kwargs in contexts)
+
+        sources = {template_path: self.__env.loader.get_source(self.__env, template_path)[0]
+                   for template_path in template_paths}
+        render_chunk = functools.partial(_render_chunk, self._tmpl_globals, self._tmpl_filters)
+        if max_pending is None:
+            max_pending = 2 * (getattr(executor, '_max_workers', None) or os.cpu_count() or 1)
+        items = ((sources[select(template_paths)], kwargs) for kwargs in contexts)
+        return self._render_chunks(executor, render_chunk, items, chunksize, max_pending)
+
+    @staticmethod
+    def _render_chunks(executor, render_chunk, items, chunksize, max_pending):
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < max_pending:
+                    chunk = list(itertools.islice(items, chunksize))
+                    if not chunk:
+                        break
+                    pending.append(executor.submit(render_chunk, chunk))
+                if not pending:
+                    return
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+_worker_templates = {}
+
+
+def _render_chunk(tmpl_globals, tmpl_filters, chunk):
+    return [_render_source(tmpl_globals, tmpl_filters, source, kwargs) for source, kwargs in chunk]
+
+
+def _render_source(tmpl_globals, tmpl_filters, source, kwargs):
+    """
+        Render template in executor worker, compiled templates are cached per worker.
+        Globals are passed to template as variables since they are unpickled for every chunk
+    """
+    key = (source, frozenset(tmpl_filters.items()))
+    tmpl = _worker_templates.get(key)
+    if tmpl is None:
+        env = jinja2.Environment(extensions=[FragmentCacheExtension])
+        env.filters.update(tmpl_filters)
+        tmpl = env.from_string(source)
+        if len(_worker_templates) >= 100:
+            _worker_templates.clear()
+        _worker_templates[key] = tmpl
+    return tmpl.render(tmpl_globals, **kwargs)
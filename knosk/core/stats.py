@@ -0,0 +1,134 @@
+import bisect
+import threading
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies with fixed buckets, percentiles are approximated by bucket upper bound
+    """
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent) -> float:
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class CacheCounter:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class TemplateStats:
+    """
+    Latency histograms and cache counters of single template split by rendering phases
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.caches = {}
+
+    def record(self, phase, seconds, cache_hit=None):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = LatencyHistogram()
+        histogram.record(seconds)
+        if cache_hit is not None:
+            cache = self.caches.get(phase)
+            if cache is None:
+                cache = self.caches[phase] = CacheCounter()
+            cache.record(cache_hit)
+
+    @property
+    def total(self) -> float:
+        return sum(histogram.total for histogram in self.phases.values())
+
+
+class RenderStats:
+    """
+    Collect per template timings of TemplateRenderer phases:
+    resolve - template lookup, load - loading and compiling template (cache hit means it was compiled before),
+    render - rendering template (cache hit means rendered string was taken from result cache)
+    """
+    PHASES = ('resolve', 'load', 'render')
+
+    def __init__(self):
+        self.__templates = {}
+        self.__lock = threading.Lock()
+
+    def record(self, template, phase, seconds, cache_hit=None):
+        with self.__lock:
+            stats = self.__templates.get(template)
+            if stats is None:
+                stats = self.__templates[template] = TemplateStats()
+            stats.record(phase, seconds, cache_hit)
+
+    def get(self, template) -> TemplateStats:
+        return self.__templates.get(template)
+
+    def templates(self) -> list:
+        """
+            Names of recorded templates, the most expensive go first
+        """
+        with self.__lock:
+            return sorted(self.__templates, key=lambda template: self.__templates[template].total, reverse=True)
+
+    def reset(self):
+        with self.__lock:
+            self.__templates = {}
+
+    def dump(self) -> str:
+        """
+            Text report, times are in milliseconds
+        """
+        lines = ["%-60s %-8s %8s %9s %9s %9s %9s %6s" % (
+            'template', 'phase', 'count', 'mean', 'p50', 'p95', 'max', 'hit%')]
+        for template in self.templates():
+            stats = self.__templates[template]
+            for phase in self.PHASES:
+                histogram = stats.phases.get(phase)
+                if histogram is None:
+                    continue
+                cache = stats.caches.get(phase)
+                lines.append("%-60s %-8s %8d %9.3f %9.3f %9.3f %9.3f %6s" % (
+                    template[-60:], phase, histogram.count, histogram.mean * 1000,
+                    histogram.percentile(50) * 1000, histogram.percentile(95) * 1000, histogram.max * 1000,
+                    '%.1f' % (cache.hit_ratio * 100) if cache else '-'))
+        return '\n'.join(lines)
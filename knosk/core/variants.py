@@ -0,0 +1,95 @@
+import random
+import itertools
+from abc import ABC, abstractmethod
+import bisect
+import os
+import re
+import zlib
+from typing import Sequence
+
+_WEIGHT_SUFFIX = re.compile(r'\.w(\d+)\.tmpl$')
+
+
+class VariantSelector(ABC):
+    """
+    Strategy how to pick one template from the folder with template variants.
+    :variants is already indexed list of template paths, :key is optional selection key
+    passed to render as tmpl_variant_key (e.g. conversation id)
+    """
+
+    @abstractmethod
+    def __call__(self, variants: Sequence[str], key=None) -> str:
+        pass
+
+
+class UniformSelector(VariantSelector):
+    """
+    Pick template randomly, pass :seed to get reproducible sequence of picks (e.g. for load tests)
+    """
+
+    def __init__(self, seed=None):
+        self.__random = random.Random(seed) if seed is not None else random
+
+    def __call__(self, variants, key=None):
+        return variants[self.__random.randrange(len(variants))]
+
+
+class WeightedSelector(VariantSelector):
+    """
+    Pick template randomly with respect to its weight.
+    Weight is taken from :weights manifest {template file name: weight}, then from file name suffix
+    e.g. greeting.w3.tmpl has weight 3, otherwise it's 1.
+    ValueError is raised for negative weights and for folders where every template has zero weight
+    """
+
+    def __init__(self, weights=None, seed=None):
+        self.__weights = weights if weights is not None else {}
+        self.__random = random.Random(seed) if seed is not None else random
+        self.__cumulative = {}
+
+    def weight(self, template_path) -> int:
+        file_name = os.path.basename(template_path)
+        if file_name in self.__weights:
+            weight = self.__weights[file_name]
+            if weight < 0:
+                raise ValueError("Weight of template %s is negative: %s" % (template_path, weight))
+            return weight
+        suffix = _WEIGHT_SUFFIX.search(file_name)
+        return int(suffix.group(1)) if suffix else 1
+
+    def __call__(self, variants, key=None):
+        cumulative = self.__cumulative.get(variants[0])
+        if cumulative is None or cumulative[0] != variants:
+            cumulative = (variants, list(itertools.accumulate(self.weight(variant) for variant in variants)))
+            if not cumulative[1][-1]:
+                raise ValueError("All templates of %s have zero weight" % os.path.dirname(variants[0]))
+            self.__cumulative[variants[0]] = cumulative
+        weights = cumulative[1]
+        return variants[bisect.bisect_right(weights, self.__random.random() * weights[-1])]
+
+
+class SeededSelector(VariantSelector):
+    """
+    Pick the same template for the same key (e.g. conversation id) in every process,
+    templates are picked randomly if key is not passed
+    """
+
+    def __call__(self, variants, key=None):
+        if key is None:
+            return random.choice(variants)
+        return variants[zlib.crc32(("%s:%s" % (key, variants[0])).encode('utf-8')) % len(variants)]
+
+
+class RoundRobinSelector(VariantSelector):
+    """
+    Pick templates of the folder one by one
+    """
+
+    def __init__(self):
+        self.__counters = {}
+
+    def __call__(self, variants, key=None):
+        counter = self.__counters.get(variants[0])
+        if counter is None:
+            counter = self.__counters.setdefault(variants[0], itertools.count())
+        return variants[next(counter) % len(variants)]
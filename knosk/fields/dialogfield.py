@@ -3,6 +3,7 @@ from knosk.fields import FieldValue, DialogFieldValue
 from knosk.choosers import Chooser
 from knosk.suggesters import Suggester
 from knosk.core import serializer
+from knosk.core.asyncutils import maybe_await
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -26,6 +27,16 @@ class OverrideField:
         self._choosers = choosers
         self._exclude = exclude
 
+    @staticmethod
+    def index(overrides: List['OverrideField']) -> dict:
+        """
+            Group overrides by source keeping their order, so field could find its overrides without scanning
+        """
+        index = {}
+        for override in overrides or []:
+            index.setdefault(override._source, []).append(override)
+        return index
+
 
 class DialogField:
 
@@ -35,9 +46,19 @@ class DialogField:
             matcher=None,
             suggesters: List[Suggester] = None,
             choosers: List[Chooser] = None,
-            exclude: DialogFieldValue = None):
+            exclude: DialogFieldValue = None,
+            depends_on: List[str] = None,
+            payload_keys: List[str] = None):
+        """
+            :depends_on is list of form field names which matcher or suggesters of this field read,
+            the field is re-evaluated when any of them is cleaned incrementally
+            :payload_keys is list of payload keys which matcher or suggesters read besides field source,
+            the field is re-evaluated when any of them changes
+        """
         self._source = source
         self._matcher = matcher
+        self._depends_on = tuple(depends_on) if depends_on else ()
+        self._payload_keys = tuple(payload_keys) if payload_keys else ()
         self._suggesters = suggesters if suggesters else []
         self._choosers = choosers if choosers else []
         self.__origin = FieldValue.empty()
@@ -49,10 +70,21 @@ class DialogField:
         LOG.info("Match field %s with value %s" % (self._source, self.__origin))
         if self._matcher:
             if not FieldValue.is_empty(self.__origin):
-                matched_value = self._matcher(self.__origin, form)
-                self._validate_match(matched_value)
-                self.__matched = FieldValue.create(matched_value)
-                LOG.info("Matched value for field %s is %s(%s)" % (self._source, self.__matched.__class__.__name__ ,self.__matched))
+                self._set_matched(self._matcher(self.__origin, form))
+
+    async def match_async(self, form):
+        """
+            Same as match but matcher could be coroutine function
+        """
+        LOG.info("Match field %s with value %s" % (self._source, self.__origin))
+        if self._matcher:
+            if not FieldValue.is_empty(self.__origin):
+                self._set_matched(await maybe_await(self._matcher(self.__origin, form)))
+
+    def _set_matched(self, matched_value):
+        self._validate_match(matched_value)
+        self.__matched = FieldValue.create(matched_value)
+        LOG.info("Matched value for field %s is %s(%s)" % (self._source, self.__matched.__class__.__name__ ,self.__matched))
 
     def _validate_match(self, value):
         if isinstance(value, list) and len(value) > 1:
@@ -66,6 +98,14 @@ class DialogField:
                 LOG.info("%s -> Choosed value is %s" % (chooser_name, choosed_value))
                 return choosed_value
 
+    async def _choose_async(self, value) -> DialogFieldValue:
+        for chooser in self._choosers:
+            chooser_name = chooser.__class__.__name__
+            choosed_value = await maybe_await(chooser(value))
+            if choosed_value and len(choosed_value) < len(value):
+                LOG.info("%s -> Choosed value is %s" % (chooser_name, choosed_value))
+                return choosed_value
+
     def suggest(self, form) -> DialogFieldValue:
         LOG.info("Suggest field %s" % self._source)
         for suggester in self._suggesters:
@@ -79,13 +119,37 @@ class DialogField:
                     choosers_result = self._choose(suggester_result)
                     result = suggester_result if not choosers_result else choosers_result
                     suggester_result_fieldvalue = self._to_suggest_fieldvalue(result)
-                self.__suggested = suggester_result_fieldvalue
-                LOG.info("Suggested FieldValue for field %s is %s" %
-                    (self._source, self.__suggested.__class__.__name__))
-                return self.__suggested
+                return self._set_suggested(suggester_result_fieldvalue)
         LOG.info("Suggested value for field %s is empty" % self._source)
         return FieldValue.empty()
 
+    async def suggest_async(self, form) -> DialogFieldValue:
+        """
+            Same as suggest but suggesters and choosers could be coroutine functions,
+            suggesters are still called one by one until first non empty result
+        """
+        LOG.info("Suggest field %s" % self._source)
+        for suggester in self._suggesters:
+            suggester_name = suggester.__class__.__name__
+            suggester_result = await maybe_await(suggester(self, form))
+            LOG.info("%s -> Suggested value for field %s is %s" %
+                (suggester_name, self._source, suggester_result))
+            if suggester_result:
+                suggester_result_fieldvalue = self._to_suggest_fieldvalue(suggester_result)
+                if FieldValue.is_suggested(suggester_result_fieldvalue):
+                    choosers_result = await self._choose_async(suggester_result)
+                    result = suggester_result if not choosers_result else choosers_result
+                    suggester_result_fieldvalue = self._to_suggest_fieldvalue(result)
+                return self._set_suggested(suggester_result_fieldvalue)
+        LOG.info("Suggested value for field %s is empty" % self._source)
+        return FieldValue.empty()
+
+    def _set_suggested(self, suggested):
+        self.__suggested = suggested
+        LOG.info("Suggested FieldValue for field %s is %s" %
+            (self._source, self.__suggested.__class__.__name__))
+        return self.__suggested
+
     def _to_suggest_fieldvalue(self, value):
         return FieldValue.create_suggested(value)
 
@@ -124,12 +188,31 @@ class DialogField:
     def source(self):
         return self._source
 
+    @property
+    def depends_on(self):
+        return self._depends_on
+
+    @property
+    def payload_keys(self):
+        """
+            All payload keys which are read by the field
+        """
+        if self._source is None:
+            return self._payload_keys
+        return (self._source,) + self._payload_keys
+
     def _fill_origin(self, raw_payload):
         self.__origin = FieldValue.create(raw_payload.get(self._source, None))
 
-    def _apply_override(self, overrides: List[OverrideField]):
-        field_overrides = [
-            override for override in overrides if override._source == self._source]
+    def _apply_override(self, overrides):
+        """
+            :overrides could be list of OverrideField or index built with OverrideField.index
+        """
+        if isinstance(overrides, dict):
+            field_overrides = overrides.get(self._source, ())
+        else:
+            field_overrides = [
+                override for override in overrides if override._source == self._source]
         if field_overrides:
             for override in field_overrides:
                 if override._suggesters:
@@ -150,6 +233,8 @@ class DialogField:
         new_field._suggesters = self._suggesters
         new_field._choosers = self._choosers
         new_field._exclude = self._exclude
+        new_field._depends_on = self._depends_on
+        new_field._payload_keys = self._payload_keys
         if not skip_payload:
             new_field._fill_origin(raw_payload)
         if overrides:
@@ -209,7 +294,16 @@ class GroupField(DialogField):
         self.__selected_field = None
 
     def match(self, form):
+        for field in self._select_field():
+            field.match(form)
+
+    async def match_async(self, form):
+        for field in self._select_field():
+            await field.match_async(form)
+
+    def _select_field(self):
         """
+        Yield fields which should be matched and select main field, caller matches every yielded field.
         The logic is the following
         if there is matcher on the field and its match field then this field is main
         if there is not matched fields take first with data and use it as main field
@@ -220,7 +314,7 @@ class GroupField(DialogField):
             if not FieldValue.is_empty(field.origin):
                 if not first_with_origin:
                     first_with_origin = field
-                field.match(form)
+                yield field
                 if not FieldValue.is_empty(field.matched):
                     self.__selected_field = field
                     return
@@ -234,6 +328,11 @@ class GroupField(DialogField):
             return self.__selected_field.suggest(form)
         return FieldValue.empty()
 
+    async def suggest_async(self, form) -> DialogFieldValue:
+        if self.__selected_field:
+            return await self.__selected_field.suggest_async(form)
+        return FieldValue.empty()
+
     @property
     def value(self):
         if self.__selected_field:
@@ -271,6 +370,13 @@ class GroupField(DialogField):
     def __fields(self):
         return self._source
 
+    @property
+    def payload_keys(self):
+        keys = ()
+        for field in self.__fields():
+            keys += field.payload_keys
+        return keys + self._payload_keys
+
     def create(
             self,
             raw_payload: dict,
@@ -289,7 +395,9 @@ class GroupField(DialogField):
             matcher=self._matcher,
             suggesters=self._suggesters,
             choosers=self._choosers,
-            exclude=self._exclude)
+            exclude=self._exclude,
+            depends_on=self._depends_on,
+            payload_keys=self._payload_keys)
         return new_field
 
     def serialize(self) -> dict:
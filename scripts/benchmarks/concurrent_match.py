@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+    Compare latency of DialogForm.match running slow matchers serially and concurrently
+
+    $ python scripts/benchmarks/concurrent_match.py --fields 8 --latency 0.05
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_dname = os.path.dirname
+
+REPO_ROOT = _dname(_dname(_dname(os.path.abspath(__file__))))
+sys.path.insert(0, REPO_ROOT)
+
+from knosk.core import DialogForm  # noqa: E402
+from knosk.fields import DialogField  # noqa: E402
+
+
+def create_form_class(fields, latency):
+    def matcher(value, form):
+        time.sleep(latency)  # request to entity service
+        return value.value
+
+    field_names = tuple('field%s' % i for i in range(fields))
+    attrs = {field_name: DialogField(source=field_name, matcher=matcher) for field_name in field_names}
+    attrs['Meta'] = type('Meta', (), {'fields': field_names})
+    return type('SlowForm', (DialogForm,), attrs)
+
+
+def measure(name, repeat, func):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - started
+    print("%-28s %8.1f ms/match" % (name, elapsed / repeat * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fields', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    form_class = create_form_class(args.fields, args.latency)
+    payload = {'field%s' % i: str(i) for i in range(args.fields)}
+
+    measure('match', args.repeat, lambda: form_class(payload).match())
+    with ThreadPoolExecutor(args.fields) as executor:
+        measure('match (%s threads)' % args.fields, args.repeat, lambda: form_class(payload).match(executor=executor))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+    Compare throughput of TemplateRenderer.render in a loop with TemplateRenderer.render_many
+
+    $ python scripts/benchmarks/render_many.py --count 100000 --workers 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+_dname = os.path.dirname
+
+REPO_ROOT = _dname(_dname(_dname(os.path.abspath(__file__))))
+sys.path.insert(0, REPO_ROOT)
+
+from knosk.core import TemplateRenderer  # noqa: E402
+
+TEMPLATE = '''Hello {{name}}!
+{% for service in services %}{{loop.index}}. {{service.name}} - {{service.price}}
+{% endfor %}'''
+
+
+def measure(name, count, func):
+    started = time.perf_counter()
+    for _ in func():
+        pass
+    elapsed = time.perf_counter() - started
+    print("%-28s %8.0f renders/s" % (name, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    services = [{'name': 'Service %s' % i, 'price': i * 10} for i in range(20)]
+    contexts = [{'name': 'User %s' % i, 'services': services} for i in range(args.count)]
+
+    with tempfile.TemporaryDirectory() as app_path:
+        folder = os.path.join(app_path, 'templates', 'ru_RU', 'text', 'campaign')
+        os.makedirs(folder)
+        with open(os.path.join(folder, '1.tmpl'), 'w') as tfile:
+            tfile.write(TEMPLATE)
+        renderer = TemplateRenderer(app_path)
+
+        measure('render', args.count, lambda: (renderer.render('campaign', **kwargs) for kwargs in contexts))
+        measure('render_many', args.count, lambda: renderer.render_many('campaign', contexts))
+        with ProcessPoolExecutor(args.workers) as executor:
+            measure('render_many (%s processes)' % args.workers, args.count,
+                    lambda: renderer.render_many('campaign', contexts, executor=executor, chunksize=500))
+
+
+if __name__ == '__main__':
+    main()
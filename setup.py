@@ -57,6 +57,8 @@ setuptools.setup(name="knosk-core",
                  license="MIT",
                  platforms="Posix; MacOS X",
                  install_requires=['jinja2', 'python-dateutil'],
+                 entry_points={'console_scripts': ['knosk-precompile=knosk.core.precompile:main',
+                                                     'knosk-bundle=knosk.core.bundle:main']},
                  python_requires='>=3.6',
                  classifiers=["Development Status :: 1 - Planning",
                               "Intended Audience :: Developers",
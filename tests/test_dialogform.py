@@ -1,8 +1,11 @@
+import asyncio
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 from knosk.fields import DialogField, GroupField, ListField, OverrideField
 from knosk.core import DialogForm
-from tests.util import SimpleForm
+from tests.util import SimpleForm, run_async
 
 
 class DialogFormTest(unittest.TestCase):
@@ -214,3 +217,241 @@ class DialogFormTest(unittest.TestCase):
         self.assertEqual(form.get('lastnames').get_value(), ['1', '3'])
         self.assertEqual(form.get('name').get_value(), ['12'])
         self.assertEqual(form.get('gp').get_value(), ['3'])
+
+    def test_field_plan_is_compiled_once(self):
+        self.assertEqual([field_name for field_name, _ in SimpleForm._field_plan], ['name', 'gp', 'lastnames'])
+        self.assertIs(SimpleForm._field_plan[0][1], SimpleForm.name)
+
+        class ExtendedForm(SimpleForm):
+            pass
+        self.assertEqual(ExtendedForm._field_plan, SimpleForm._field_plan)
+        self.assertEqual(DialogForm._field_plan, ())
+
+    def test_base_form_without_field_definitions(self):
+        class BaseForm(DialogForm):
+            class Meta:
+                fields = ('name',)
+
+        class NameMixin:
+            name = DialogField(source='name')
+
+        class NameForm(NameMixin, BaseForm):
+            pass
+        self.assertEqual(NameForm({'name': 'Vasia'}).get('name').origin.value, ['Vasia'])
+        with self.assertRaisesRegex(AttributeError, 'name'):
+            BaseForm({'name': 'Vasia'})
+
+    def test_overrides_index(self):
+        first = OverrideField(source='name', suggesters=[lambda field, form: ['1']])
+        second = OverrideField(source='name', choosers=[lambda value: value])
+        other = OverrideField(source='some')
+        index = OverrideField.index([first, other, second])
+        self.assertEqual(index, {'name': [first, second], 'some': [other]})
+        field = SimpleForm.name.create({'name': 'Vasia'}, overrides=index)
+        self.assertIs(field._suggesters, first._suggesters)
+        self.assertIs(field._choosers, second._choosers)
+
+    def test_incremental_clean_field_data(self):
+        calls = []
+
+        def matcher(value, form):
+            calls.append(('match', value.value[0]))
+            return value.value
+
+        def suggester(field, form):
+            calls.append(('suggest', field.source))
+            return ['suggested']
+
+        class BookingForm(DialogForm):
+            service = DialogField(source='service', matcher=matcher, suggesters=[suggester])
+            master = DialogField(source='master', matcher=matcher, suggesters=[suggester], depends_on=['service'])
+            time = DialogField(source='time', matcher=matcher, suggesters=[suggester])
+
+            class Meta:
+                fields = ('service', 'master', 'time')
+        form = BookingForm({'service': 'cut', 'master': 'bob', 'time': '10'})
+        form.match()
+        form.suggest()
+        self.assertEqual(len(calls), 6)
+
+        del calls[:]
+        form.clean_field_data('service', incremental=True)
+        self.assertEqual(form.get('service').get_value(), [])
+        self.assertEqual(form.get('time').get_value(), ['suggested'])
+        form.match()
+        form.suggest()
+        self.assertEqual(calls, [('match', 'bob'), ('suggest', 'service'), ('suggest', 'master')])
+        self.assertEqual(form.get('service').get_value(), ['suggested'])
+
+        # next turn evaluates whole form again, cleaned field has no origin to match
+        del calls[:]
+        form.match()
+        self.assertEqual(calls, [('match', 'bob'), ('match', '10')])
+
+    def test_depends_on_unknown_field(self):
+        with self.assertRaises(ValueError):
+            class BrokenForm(DialogForm):
+                master = DialogField(source='master', depends_on=['service'])
+
+                class Meta:
+                    fields = ('master',)
+
+    def test_update_payload_reevaluates_dirty_fields(self):
+        calls = []
+
+        def matcher(value, form):
+            calls.append(('match', value.value[0]))
+            return value.value
+
+        def suggester(field, form):
+            calls.append(('suggest', field.source))
+            return ['suggested']
+
+        fields = {'f%s' % i: DialogField(source='f%s' % i, matcher=matcher, suggesters=[suggester])
+                  for i in range(10)}
+        fields['slot'] = DialogField(source='slot', matcher=matcher, suggesters=[suggester],
+                                     depends_on=['f9'], payload_keys=['date'])
+        BookingForm = type('BookingForm', (DialogForm,), dict(fields, Meta=type('Meta', (), {
+            'fields': ('slot',) + tuple('f%s' % i for i in range(10))})))
+        self.assertEqual(BookingForm._field_order[:2], ('f9', 'slot'))
+
+        payload = {'f%s' % i: str(i) for i in range(10)}
+        payload.update({'slot': 's', 'date': 'today'})
+        form = BookingForm(payload)
+        form.match()
+        self.assertEqual(calls[:2], [('match', '9'), ('match', 's')])
+        form.suggest()
+
+        del calls[:]
+        form.update_payload(dict(payload, f3='33'))
+        form.match()
+        form.suggest()
+        self.assertEqual(calls, [('match', '33'), ('suggest', 'f3')])
+
+        del calls[:]
+        form.update_payload(dict(payload, f3='33', date='tomorrow'))
+        form.match()
+        form.suggest()
+        self.assertEqual(calls, [('match', 's'), ('suggest', 'slot')])
+
+    def test_cyclic_field_dependencies(self):
+        with self.assertRaisesRegex(ValueError, "a -> b -> a"):
+            class BrokenForm(DialogForm):
+                a = DialogField(source='a', depends_on=['b'])
+                b = DialogField(source='b', depends_on=['a'])
+
+                class Meta:
+                    fields = ('a', 'b')
+
+    def test_concurrent_match(self):
+        def matcher(value, form):
+            if form.barrier:
+                form.barrier.wait()  # fails unless all matchers of the wave run at once
+            if value.value[0].startswith('broken'):
+                raise ValueError(value.value[0])
+            return value.value
+
+        def dependent_matcher(value, form):
+            return form.get('a').get_value() + value.value
+
+        class ConcurrentForm(DialogForm):
+            a = DialogField(source='a', matcher=matcher)
+            b = DialogField(source='b', matcher=matcher)
+            c = DialogField(source='c', matcher=matcher)
+            d = ListField(source='d', matcher=dependent_matcher, depends_on=['a'])
+
+            match_max_workers = 3
+
+            class Meta:
+                fields = ('d', 'a', 'b', 'c')
+        form = ConcurrentForm({'a': '1', 'b': '2', 'c': '3', 'd': '4'}, barrier=threading.Barrier(3, timeout=5))
+        self.assertEqual(form._match_waves(['a', 'd', 'b', 'c']), [['a', 'b', 'c'], ['d']])
+        form.match()
+        self.assertEqual(form.to_dict(), {'a': ['1'], 'b': ['2'], 'c': ['3'], 'd': ['1', '4']})
+        form = ConcurrentForm({'a': '1', 'b': '2', 'c': '3', 'd': '4'}, barrier=threading.Barrier(3, timeout=5))
+        form.match()
+        self.assertIs(ConcurrentForm._get_match_executor(), ConcurrentForm._match_executor)
+        self.assertNotIn('_match_executor', DialogForm.__dict__)
+
+        form = ConcurrentForm({'a': '1', 'b': 'broken b', 'c': 'broken c', 'd': '4'}, barrier=None)
+        with ThreadPoolExecutor(2) as executor:
+            with self.assertRaisesRegex(ValueError, 'broken b'):
+                form.match(executor=executor)
+        self.assertEqual(form.get('d').get_value(), [])
+
+    def test_handle_async(self):
+        validated = []
+
+        async def matcher(value, form):
+            await asyncio.sleep(0)
+            return value.value
+
+        async def empty_suggester(field, form):
+            return []
+
+        async def suggester(field, form):
+            return ['TTT', 'HHH']
+
+        def unused_suggester(field, form):
+            raise AssertionError("Only first non empty suggester is used")
+
+        async def chooser(value):
+            return [value[-1]]
+
+        def matched_suggester(field, form):
+            return field.matched.value
+
+        class AsyncForm(DialogForm):
+            name = DialogField(source='name', matcher=matcher, suggesters=[matched_suggester])
+            master = DialogField(source='master', suggesters=[empty_suggester, suggester, unused_suggester],
+                                 choosers=[chooser])
+            gp = GroupField(source=[DialogField(source='f1', matcher=matcher, suggesters=[matched_suggester])])
+
+            class Meta:
+                fields = ('name', 'master', 'gp')
+
+            async def validate_form(self, **kwargs):
+                validated.append(kwargs)
+
+        form = AsyncForm({'name': 'Vasia', 'f1': '1'})
+        self.assertIsNone(run_async(form.handle_async(dialog='dialog')))
+        self.assertEqual(form.to_dict(), {'name': ['Vasia'], 'master': ['HHH'], 'gp': ['1']})
+        self.assertEqual(validated, [{'dialog': 'dialog'}])
+
+    def test_concurrent_match_async(self):
+        async def matcher(value, form):
+            form.arrived += 1
+            if form.arrived == 3:
+                form.all_arrived.set()
+            # fails unless all matchers run at once
+            await asyncio.wait_for(form.all_arrived.wait(), 5)
+            if value.value[0].startswith('broken'):
+                raise ValueError(value.value[0])
+            return value.value
+
+        class AsyncForm(DialogForm):
+            a = DialogField(source='a', matcher=matcher)
+            b = DialogField(source='b', matcher=matcher)
+            c = DialogField(source='c', matcher=matcher)
+
+            class Meta:
+                fields = ('a', 'b', 'c')
+
+        async def match(payload):
+            form = AsyncForm(payload, arrived=0, all_arrived=asyncio.Event())
+            await form.match_async(concurrent=True)
+            return form
+        form = run_async(match({'a': '1', 'b': '2', 'c': '3'}))
+        self.assertEqual(form.to_dict(), {'a': ['1'], 'b': ['2'], 'c': ['3']})
+
+        with self.assertRaisesRegex(ValueError, 'broken b'):
+            run_async(match({'a': '1', 'b': 'broken b', 'c': 'broken c'}))
+
+        class OptInForm(AsyncForm):
+            match_max_workers = 3
+
+        async def handle():
+            form = OptInForm({'a': '1', 'b': '2', 'c': '3'}, arrived=0, all_arrived=asyncio.Event())
+            await form.handle_async()
+            return form
+        self.assertEqual(run_async(handle()).to_dict(), {'a': ['1'], 'b': ['2'], 'c': ['3']})
@@ -1,6 +1,16 @@
+import asyncio
+import importlib
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-from knosk.core import Flow
+from knosk.core import Flow, FlowRegistry
+from knosk.core import flowmanager
+from knosk.core.flowmanager import CircuitOpen, RouteTimeout
+from knosk.core.middleware import Middleware, MetricsMiddleware
+from tests.util import run_async
 
 
 class FlowManagerTest(unittest.TestCase):
@@ -82,3 +92,457 @@ class FlowManagerTest(unittest.TestCase):
             raise Exception()
 
         f.handle("test", {"a": "a"})
+
+    def test_async_routing(self):
+        f = Flow()
+        calls = []
+
+        async def banned(flow, route_name, payload, ctx):
+            calls.append('banned')
+            return None
+
+        def expired(flow, route_name, payload, ctx):
+            calls.append('expired')
+            return None
+
+        @f.handler("test", conditions=[banned, expired])
+        async def h(flow, route_name, payload, ctx):
+            return await flow.render_async("somerender", payload, ctx)
+
+        @f.renderer("somerender")
+        def r(flow, route_name, payload, ctx):
+            return "render %s" % payload["a"]
+
+        self.assertEqual(run_async(f.handle_async("test", {"a": "a"})), "render a")
+        self.assertEqual(calls, ['banned', 'expired'])
+
+    def test_async_routing_with_negative_conditions(self):
+        f = Flow()
+        calls = []
+
+        async def condition(flow, route_name, payload, ctx):
+            return "stop"
+
+        def never(flow, route_name, payload, ctx):
+            calls.append('never')
+
+        @f.handler("test", conditions=[condition, never])
+        async def h(flow, route_name, payload, ctx):
+            calls.append('handler')
+
+        self.assertEqual(run_async(f.handle_async("test")), "stop")
+        self.assertEqual(calls, [])
+
+    def test_async_fallback(self):
+        async def fallback(ex, route_name, payload, ctx):
+            return "fallback %s" % route_name
+
+        f = Flow(fallback)
+
+        @f.handler("test")
+        async def h(flow, route_name, payload, ctx):
+            raise Exception()
+
+        self.assertEqual(run_async(f.handle_async("test")), "fallback test")
+        self.assertEqual(run_async(f.handle_async("missing")), "fallback missing")
+
+    def test_wildcard_routing(self):
+        f = Flow()
+
+        @f.handler("booking.*")
+        def booking(flow, route_name, payload, ctx):
+            return "booking %s" % route_name
+
+        @f.handler("booking.ask.*")
+        def ask(flow, route_name, payload, ctx):
+            return "ask %s" % route_name
+
+        @f.handler("booking.ask.master")
+        def master(flow, route_name, payload, ctx):
+            return "master"
+
+        @f.handler("*")
+        def everything(flow, route_name, payload, ctx):
+            return "everything %s" % route_name
+
+        self.assertEqual(f.handle("booking.ask.master"), "master")
+        self.assertEqual(f.handle("booking.ask.time"), "ask booking.ask.time")
+        self.assertEqual(f.handle("booking.confirm"), "booking booking.confirm")
+        self.assertEqual(f.handle("booking"), "everything booking")
+        self.assertEqual(f.handle("help"), "everything help")
+        self.assertEqual(sorted(f.handler_names()), ["*", "booking.*", "booking.ask.*", "booking.ask.master"])
+
+    def test_wildcard_only_at_the_end(self):
+        f = Flow()
+        with self.assertRaises(ValueError):
+            f.handler("booking.*.master")(lambda flow, route_name, payload, ctx: None)
+
+    def test_middleware_hooks(self):
+        f = Flow(lambda ex, route_name, payload, ctx: "fallback")
+        calls = []
+
+        class Recorder(Middleware):
+
+            def __init__(self, name):
+                self.name = name
+
+            def before(self, call):
+                calls.append((self.name, 'before', call.route_name))
+
+            def after(self, call, result):
+                calls.append((self.name, 'after', result))
+
+            def error(self, call, ex):
+                calls.append((self.name, 'error', str(ex)))
+
+        f.use(Recorder('first'))
+        f.use(Recorder('second'))
+
+        @f.handler("test")
+        def h(flow, route_name, payload, ctx):
+            return "result"
+
+        @f.handler("broken")
+        def b(flow, route_name, payload, ctx):
+            raise ValueError("broken")
+
+        self.assertEqual(f.handle("test"), "result")
+        self.assertEqual(f.handle("broken"), "fallback")
+        self.assertEqual(calls, [('first', 'before', 'test'), ('second', 'before', 'test'),
+                                 ('second', 'after', 'result'), ('first', 'after', 'result'),
+                                 ('first', 'before', 'broken'), ('second', 'before', 'broken'),
+                                 ('second', 'error', 'broken'), ('first', 'error', 'broken')])
+
+    def test_metrics_middleware(self):
+        f = Flow(lambda ex, route_name, payload, ctx: "fallback")
+        metrics = f.use(MetricsMiddleware())
+
+        def banned(flow, route_name, payload, ctx):
+            return "banned" if payload.get("banned") else None
+
+        @f.handler("test", conditions=[banned])
+        def h(flow, route_name, payload, ctx):
+            if payload.get("broken"):
+                raise ValueError()
+            return flow.render("reply", payload, ctx)
+
+        @f.renderer("reply")
+        def r(flow, route_name, payload, ctx):
+            return "reply"
+
+        f.handle("test", {"a": "a"})
+        f.handle("test", {"banned": True})
+        f.handle("test", {"broken": True})
+        run_async(f.handle_async("test", {"a": "a"}))
+
+        handler_metrics = metrics.get("test")
+        self.assertEqual((handler_metrics.calls, handler_metrics.errors, handler_metrics.short_circuits), (4, 1, 1))
+        self.assertEqual(handler_metrics.latency.count, 4)
+        self.assertEqual(metrics.get("reply", kind='renderer').calls, 2)
+        self.assertIn("reply", metrics.dump())
+
+    def test_turn_memoizes_conditions(self):
+        f = Flow()
+        calls = []
+
+        def banned(flow, route_name, payload, ctx):
+            calls.append(route_name)
+            return None
+
+        @f.handler("test", conditions=[banned])
+        def h(flow, route_name, payload, ctx):
+            return flow.render("test", payload, ctx)
+
+        @f.renderer("test", conditions=[banned])
+        def r(flow, route_name, payload, ctx):
+            return "render"
+
+        payload = {"a": "a"}
+        ctx = {}
+        with f.turn(ctx):
+            self.assertEqual(f.handle("test", payload, ctx), "render")
+            self.assertEqual(f.render("test", payload, ctx), "render")
+            self.assertEqual(run_async(f.render_async("test", payload, ctx)), "render")
+            f.render("test", {"a": "b"}, ctx)
+        self.assertEqual(calls, ["test", "test"])
+
+        f.handle("test", payload, ctx)
+        self.assertEqual(len(calls), 4)
+
+    def test_turn_memoizes_conditions_for_empty_payload(self):
+        f = Flow()
+        calls = []
+
+        def banned(flow, route_name, payload, ctx):
+            calls.append(route_name)
+            return None
+
+        @f.handler("test", conditions=[banned])
+        def h(flow, route_name, payload, ctx):
+            flow.render("test", None, ctx)
+            return flow.render("test", {}, ctx)
+
+        @f.renderer("test", conditions=[banned])
+        def r(flow, route_name, payload, ctx):
+            return "render"
+
+        ctx = {}
+        with f.turn(ctx):
+            self.assertEqual(f.handle("test", None, ctx), "render")
+            self.assertEqual(run_async(f.render_async("test", {}, ctx)), "render")
+        self.assertEqual(calls, ["test"])
+
+    def test_lazy_registration(self):
+        f = Flow()
+        f.register_handler("test", "tests.util:lazy_handler", conditions=["tests.util:lazy_condition"])
+        f.register_renderer("test.*", "tests.util:lazy_handler")
+        with mock.patch('importlib.import_module', wraps=importlib.import_module) as import_mock:
+            self.assertEqual(f.handle("test", {"a": "a"}), ("test", {"a": "a"}))
+            self.assertEqual(f.handle("test", {"stop": True}), "stopped")
+            self.assertEqual(import_mock.call_count, 2)
+            self.assertEqual(f.warm_up(), 2)
+            self.assertEqual(import_mock.call_count, 2)
+        self.assertEqual(f.render("test.x"), ("test.x", {}))
+
+    def test_lazy_registration_of_missing_handler(self):
+        f = Flow(lambda ex, route_name, payload, ctx: type(ex))
+        f.register_handler("test", "tests.util:missing_handler")
+        self.assertEqual(f.handle("test"), AttributeError)
+        with self.assertRaises(AttributeError):
+            f.warm_up()
+        with self.assertRaises(ValueError):
+            f.register_handler("bad", "tests.util.lazy_handler")
+        with self.assertRaises(ValueError):
+            f.register_renderer("bad", "tests.util:lazy_handler", conditions=["tests.util"])
+
+    def test_flow_registry(self):
+        built = []
+
+        def booking_bot(flow):
+            built.append(flow)
+
+            @flow.handler("test")
+            def h(flow, route_name, payload, ctx):
+                return "booking"
+
+        def other_bot(flow):
+            flow.register_handler("test", "tests.util:lazy_handler")
+
+        registry = FlowRegistry(max_flows=2)
+        registry.register(1, booking_bot)
+        registry.register(2, booking_bot, fallback=lambda ex, route_name, payload, ctx: "fallback")
+        registry.register(3, other_bot)
+
+        with ThreadPoolExecutor(8) as executor:
+            flows = list(executor.map(registry.get, [1] * 20))
+        self.assertTrue(all(flow is flows[0] for flow in flows))
+        first, second = registry.get(1), registry.get(2)
+        self.assertIsNot(first, second)
+        self.assertIs(first.routes, second.routes)
+        self.assertEqual(len(built), 1)
+        self.assertEqual(second.handle("missing"), "fallback")
+        self.assertEqual(registry.get(3).handle("test"), ("test", {}))
+
+        self.assertEqual(len(registry), 2)
+        self.assertNotIn(1, registry)
+        self.assertIsNot(registry.get(1), first)
+        with self.assertRaises(RuntimeError):
+            first.handler("new")(lambda flow, route_name, payload, ctx: None)
+        with self.assertRaises(KeyError):
+            registry.get(4)
+
+    def test_flow_registry_configures_every_flow(self):
+        def booking_bot(flow):
+            flow.handler("test")(lambda flow, route_name, payload, ctx: "booking")
+
+        def configure(flow):
+            flow.use(MetricsMiddleware())
+            flow.timeout = 5
+
+        def broken_bot(flow):
+            flow.use(MetricsMiddleware())
+
+        registry = FlowRegistry(max_flows=1)
+        registry.register(1, booking_bot, configure=configure)
+        registry.register(2, booking_bot, configure=configure)
+        registry.register(3, broken_bot)
+        first, second = registry.get(1), registry.get(2)
+        rebuilt = registry.get(1)
+        self.assertIsNot(rebuilt, first)
+        for flow in (first, second, rebuilt):
+            self.assertEqual(len(flow.middlewares), 1)
+            self.assertEqual(flow.timeout, 5)
+        self.assertIsNot(first.middlewares[0], second.middlewares[0])
+        with self.assertRaises(ValueError):
+            registry.get(3)
+
+    def test_flow_registry_builds_outside_of_lock(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_bot(flow):
+            started.set()
+            release.wait(5)
+
+        registry = FlowRegistry()
+        registry.register(1, lambda flow: None)
+        registry.register(2, slow_bot)
+        cached = registry.get(1)
+        with ThreadPoolExecutor(3) as executor:
+            slow = [executor.submit(registry.get, 2) for _ in range(2)]
+            self.assertTrue(started.wait(5))
+            self.assertIs(executor.submit(registry.get, 1).result(1), cached)
+            release.set()
+            self.assertIs(slow[0].result(5), slow[1].result(5))
+
+    def test_flow_registry_evicts_idle_flows(self):
+        registry = FlowRegistry(idle_ttl=10)
+        registry.register(1, lambda flow: None)
+        registry.register(2, lambda flow: None)
+        with mock.patch('time.monotonic', return_value=100):
+            registry.get(1)
+        with mock.patch('time.monotonic', return_value=105):
+            registry.get(2)
+        with mock.patch('time.monotonic', return_value=112):
+            registry.get(2)
+        self.assertNotIn(1, registry)
+        self.assertIn(2, registry)
+
+    def test_handle_batch(self):
+        f = Flow()
+        handled = []
+
+        @f.handler("test")
+        def h(flow, route_name, payload, ctx):
+            time.sleep(payload["sleep"])
+            handled.append((payload["conversation"], payload["turn"]))
+            if payload["turn"] == 1 and payload["conversation"] == 'b':
+                raise ValueError("broken")
+            return payload["turn"]
+
+        items = [(conversation, "test", {"conversation": conversation, "turn": turn, "sleep": sleep}, {})
+                 for turn in range(3) for conversation, sleep in (('a', 0.02), ('b', 0.0), ('c', 0.01))]
+        with mock.patch('knosk.core.flowmanager.LOG'):
+            results = list(f.handle_batch(iter(items), max_workers=3, max_pending=4))
+        self.assertEqual(len(results), 9)
+        for conversation in ('a', 'b', 'c'):
+            self.assertEqual([turn for conv, turn in handled if conv == conversation], [0, 1, 2])
+            self.assertEqual([result.result for result in results if result.conversation_id == conversation],
+                             [0, None, 2] if conversation == 'b' else [0, 1, 2])
+        self.assertIsInstance([result.error for result in results if result.conversation_id == 'b'][1], ValueError)
+
+    def test_circuit_breaker_probe_is_cancelled(self):
+        f = Flow(fallback=lambda ex, route_name, payload, ctx: type(ex), breaker_threshold=1, breaker_reset_timeout=0)
+
+        @f.handler("test")
+        async def h(flow, route_name, payload, ctx):
+            if payload.get("fail"):
+                raise ValueError("broken")
+            if payload.get("hang"):
+                await asyncio.Event().wait()
+            return "ok"
+
+        async def scenario():
+            self.assertIs(await f.handle_async("test", {"fail": True}), ValueError)
+            probe = asyncio.ensure_future(f.handle_async("test", {"hang": True}))
+            await asyncio.sleep(0)
+            self.assertIs(await f.handle_async("test"), CircuitOpen)
+            probe.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await probe
+            return await f.handle_async("test")
+        self.assertEqual(run_async(scenario()), "ok")
+
+    def test_route_timeout(self):
+        f = Flow(fallback=lambda ex, route_name, payload, ctx: type(ex), timeout=5)
+
+        @f.handler("slow", timeout=0.01)
+        def slow(flow, route_name, payload, ctx):
+            time.sleep(0.1)
+            return "slow"
+
+        @f.handler("fast")
+        def fast(flow, route_name, payload, ctx):
+            return "fast"
+
+        @f.renderer("slow", timeout=0.01)
+        async def slow_async(flow, route_name, payload, ctx):
+            await asyncio.sleep(0.1)
+            return "slow"
+
+        self.assertIs(f.handle("slow"), RouteTimeout)
+        self.assertEqual(f.handle("fast"), "fast")
+        self.assertIs(run_async(f.render_async("slow")), RouteTimeout)
+
+    def test_route_deadline_bulkhead(self):
+        f = Flow(fallback=lambda ex, route_name, payload, ctx: type(ex), timeout=0.05, breaker_threshold=1,
+                 route_deadline_workers=2)
+        release = threading.Event()
+
+        @f.handler("slow_crm")
+        def slow_crm(flow, route_name, payload, ctx):
+            release.wait(5)
+            return "crm"
+
+        @f.handler("healthy")
+        def healthy(flow, route_name, payload, ctx):
+            return "ok"
+
+        pool = ThreadPoolExecutor(2)
+        try:
+            with mock.patch.object(flowmanager, '_deadline_executor', pool), ThreadPoolExecutor(4) as callers:
+                results = list(callers.map(lambda _: f.handle("slow_crm"), range(4)))
+                self.assertEqual(sorted(result.__name__ for result in results),
+                                 ['RouteNotStarted', 'RouteNotStarted', 'RouteTimeout', 'RouteTimeout'])
+                # pool is held by hanging route, healthy route is not started but its circuit stays closed
+                self.assertIs(f.handle("healthy"), flowmanager.RouteNotStarted)
+                self.assertIs(f.handle("healthy"), flowmanager.RouteNotStarted)
+                release.set()
+                pool.submit(lambda: None).result(5)
+                self.assertEqual(f.handle("healthy"), "ok")
+        finally:
+            release.set()
+            pool.shutdown()
+
+    def test_route_timeout_reuses_deadline_threads(self):
+        f = Flow(timeout=5)
+        threads = []
+
+        @f.handler("outer")
+        def outer(flow, route_name, payload, ctx):
+            threads.append(threading.current_thread())
+            return flow.handle("inner")
+
+        @f.handler("inner")
+        def inner(flow, route_name, payload, ctx):
+            threads.append(threading.current_thread())
+            return "inner"
+
+        started = threading.active_count()
+        for _ in range(50):
+            self.assertEqual(f.handle("outer"), "inner")
+        self.assertIs(threads[0], threads[1])
+        self.assertLessEqual(threading.active_count() - started, flowmanager.DEADLINE_WORKERS)
+
+    def test_circuit_breaker(self):
+        f = Flow(fallback=lambda ex, route_name, payload, ctx: type(ex), breaker_threshold=2, breaker_reset_timeout=10)
+        calls = []
+
+        @f.handler("test")
+        def h(flow, route_name, payload, ctx):
+            calls.append(payload.get("fail"))
+            if payload.get("fail"):
+                raise ValueError("broken")
+            return "ok"
+
+        with mock.patch('time.monotonic', return_value=100):
+            self.assertIs(f.handle("test", {"fail": True}), ValueError)
+            self.assertIs(f.handle("test", {"fail": True}), ValueError)
+            self.assertIs(f.handle("test"), CircuitOpen)
+        self.assertEqual(len(calls), 2)
+        with mock.patch('time.monotonic', return_value=111):
+            self.assertIs(f.handle("test", {"fail": True}), ValueError)
+            self.assertIs(f.handle("test"), CircuitOpen)
+        with mock.patch('time.monotonic', return_value=122):
+            self.assertEqual(f.handle("test"), "ok")
+            self.assertEqual(f.handle("test"), "ok")
+        self.assertEqual(len(calls), 5)
@@ -1,7 +1,31 @@
+import os
+import tempfile
 import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from unittest import mock
 
+import jinja2
+
 from knosk.core import TemplateRenderer
+from knosk.core import precompile
+from knosk.core.bundle import build_bundle
+from knosk.core.messages import ButtonsMessage, TextMessage
+from knosk.core.stats import LatencyHistogram, RenderStats
+from knosk.core.variants import (RoundRobinSelector, SeededSelector, UniformSelector, VariantSelector,
+                                 WeightedSelector)
+from tests.util import run_async
+
+
+def make_templates(root, templates):
+    for path, content in templates.items():
+        full_path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as tfile:
+            tfile.write(content)
+
+
+def shout(value):
+    return '%s!' % value
 
 
 class RenderTest(unittest.TestCase):
@@ -105,3 +129,292 @@ class RenderTest(unittest.TestCase):
                                  tmpl_custom_folders=['organizations/1'], a='1')
         open_mock.assert_called_with('test_application/templates/organizations/1/en_US/facebook/test/1.tmpl', 'r')
         self.assertEqual(result, 'Test template content 1-RRR')
+
+    def test_render_uses_compiled_template_cache(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Hello {{a}}'})
+            renderer = TemplateRenderer(app_path)
+            self.assertEqual(renderer.render('test', a='1'), 'Hello 1')
+            with mock.patch('builtins.open') as open_mock:
+                self.assertEqual(renderer.render('test', a='2'), 'Hello 2')
+                open_mock.assert_not_called()
+
+    def test_render_reloads_modified_template(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Hello {{a}}'})
+            renderer = TemplateRenderer(app_path)
+            self.assertEqual(renderer.render('test', a='1'), 'Hello 1')
+            tmpl_path = os.path.join(app_path, 'templates/ru_RU/text/test/1.tmpl')
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Bye {{a}}'})
+            mtime = os.path.getmtime(tmpl_path) + 10
+            os.utime(tmpl_path, (mtime, mtime))
+            self.assertEqual(renderer.render('test', a='1'), 'Bye 1')
+
+    def test_render_from_index(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Main {{a}}',
+                                      'templates/organizations/1/ru_RU/facebook/test/1.tmpl': 'Custom {{a}}'})
+            renderer = TemplateRenderer(app_path, indexed_locations=['templates'])
+            with mock.patch('os.path.isdir') as isdir_mock, mock.patch('os.listdir') as listdir_mock:
+                self.assertEqual(renderer.render('test', tmpl_type='facebook', a='1'), 'Main 1')
+                self.assertEqual(renderer.render('test', tmpl_type='facebook',
+                                                 tmpl_custom_folders=['organizations/2', 'organizations/1'], a='1'),
+                                 'Custom 1')
+                isdir_mock.assert_not_called()
+                listdir_mock.assert_not_called()
+            with self.assertRaises(ValueError):
+                renderer.render('missing')
+
+    def test_rescan_templates(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Main'})
+            renderer = TemplateRenderer(app_path, indexed_locations=['templates'])
+            make_templates(app_path, {'templates/organizations/1/ru_RU/text/test/1.tmpl': 'Custom'})
+            self.assertEqual(renderer.render('test', tmpl_custom_folders=['organizations/1']), 'Main')
+            renderer.rescan_templates()
+            self.assertEqual(renderer.render('test', tmpl_custom_folders=['organizations/1']), 'Custom')
+
+    def test_render_with_negative_cache(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Main'})
+            renderer = TemplateRenderer(app_path, negative_cache_ttl=60)
+            self.assertEqual(renderer.render('test', tmpl_custom_folders=['organizations/1']), 'Main')
+            with mock.patch('os.path.isdir', wraps=os.path.isdir) as isdir_mock:
+                self.assertEqual(renderer.render('test', tmpl_custom_folders=['organizations/1']), 'Main')
+                checked = [call[0][0] for call in isdir_mock.call_args_list]
+                self.assertFalse([path for path in checked if 'organizations' in path])
+            make_templates(app_path, {'templates/organizations/1/ru_RU/text/test/1.tmpl': 'Custom'})
+            self.assertEqual(renderer.render('test', tmpl_custom_folders=['organizations/1']), 'Main')
+            renderer.rescan_templates()
+            self.assertEqual(renderer.render('test', tmpl_custom_folders=['organizations/1']), 'Custom')
+
+    def test_render_from_precompiled_templates(self):
+        with tempfile.TemporaryDirectory() as app_path, tempfile.TemporaryDirectory() as cache_dir:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Hello {{a}}',
+                                      'templates/organizations/1/ru_RU/text/test/1.tmpl': 'Custom {{a}}'})
+            with mock.patch('sys.stdout'):
+                self.assertEqual(precompile.main([app_path, cache_dir]), 0)
+            renderer = TemplateRenderer(app_path, bytecode_cache_dir=cache_dir)
+            with mock.patch.object(jinja2.Environment, 'compile') as compile_mock:
+                self.assertEqual(renderer.render('test', a='1'), 'Hello 1')
+                self.assertEqual(renderer.render('test', tmpl_custom_folders=['organizations/1'], a='1'),
+                                 'Custom 1')
+                self.assertEqual(run_async(renderer.render_async('test', a='1')), 'Hello 1')
+                compile_mock.assert_not_called()
+
+    def test_precompile_reports_broken_templates(self):
+        with tempfile.TemporaryDirectory() as app_path, tempfile.TemporaryDirectory() as cache_dir:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Hello {{a}}',
+                                      'templates/ru_RU/text/test/2.tmpl': 'Hello {{a'})
+            renderer = TemplateRenderer(app_path, bytecode_cache_dir=cache_dir)
+            errors = []
+            compiled = renderer.precompile(on_error=lambda path, ex: errors.append(path))
+            self.assertEqual(compiled, 1)
+            self.assertEqual(errors, [os.path.join(app_path, 'templates/ru_RU/text/test/2.tmpl')])
+
+    def test_render_async(self):
+        async def master_name(master_id):
+            return 'Master %s' % master_id
+
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Hello {{a}}, {{master_name(1)}}'})
+            renderer = TemplateRenderer(app_path, tmpl_globals={'master_name': master_name})
+            result = run_async(renderer.render_async('test', a='1'))
+            self.assertEqual(result, 'Hello 1, Master 1')
+
+    def test_render_many(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Hello {{a|shout}} {{x}}'})
+            renderer = TemplateRenderer(app_path, tmpl_globals={'x': 'RRR'}, tmpl_filters={'shout': shout})
+            contexts = [{'a': str(i)} for i in range(5)]
+            expected = ['Hello %s! RRR' % i for i in range(5)]
+            with mock.patch.object(jinja2.Environment, 'compile', wraps=renderer._create_environment().compile) as m:
+                self.assertEqual(list(renderer.render_many('test', contexts)), expected)
+                self.assertEqual(m.call_count, 1)
+            with ThreadPoolExecutor(2) as executor:
+                self.assertEqual(list(renderer.render_many('test', contexts, executor=executor, chunksize=2)),
+                                 expected)
+            with ProcessPoolExecutor(2) as executor:
+                self.assertEqual(list(renderer.render_many('test', contexts, executor=executor, chunksize=2)),
+                                 expected)
+
+    def test_render_many_reads_contexts_lazily(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Hello {{a}}'})
+            renderer = TemplateRenderer(app_path)
+            consumed = []
+
+            def contexts():
+                for i in range(1000):
+                    consumed.append(i)
+                    yield {'a': i}
+            with ThreadPoolExecutor(2) as executor:
+                results = renderer.render_many('test', contexts(), executor=executor, chunksize=10, max_pending=3)
+                self.assertEqual(next(results), 'Hello 0')
+                self.assertLessEqual(len(consumed), 40)
+                self.assertEqual(len(list(results)), 999)
+
+    def test_render_from_bundle(self):
+        with tempfile.TemporaryDirectory() as app_path, tempfile.TemporaryDirectory() as bundle_dir:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Main {{a}}',
+                                      'templates/organizations/1/ru_RU/text/test/1.tmpl': 'Custom {{a}}'})
+            bundle_path = os.path.join(bundle_dir, 'templates.bundle')
+            self.assertEqual(build_bundle(app_path, bundle_path), 2)
+            renderer = TemplateRenderer(app_path, bundle_path=bundle_path)
+            with mock.patch('builtins.open') as open_mock, mock.patch('os.path.isdir') as isdir_mock:
+                self.assertEqual(renderer.render('test', a='1'), 'Main 1')
+                self.assertEqual(renderer.render('test', tmpl_custom_folders=['organizations/1'], a='1'), 'Custom 1')
+                open_mock.assert_not_called()
+                isdir_mock.assert_not_called()
+
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Updated {{a}}'})
+            build_bundle(app_path, bundle_path)
+            self.assertEqual(renderer.render('test', a='1'), 'Main 1')
+            renderer.rescan_templates()
+            self.assertEqual(renderer.render('test', a='1'), 'Updated 1')
+
+    def test_render_nested_template_name(self):
+        with tempfile.TemporaryDirectory() as app_path, tempfile.TemporaryDirectory() as bundle_dir:
+            make_templates(app_path, {'templates/ru_RU/text/booking/ask/1.tmpl': 'Main',
+                                      'templates/organizations/1/ru_RU/text/booking/ask/1.tmpl': 'Custom'})
+            bundle_path = os.path.join(bundle_dir, 'templates.bundle')
+            build_bundle(app_path, bundle_path)
+            for renderer in (TemplateRenderer(app_path), TemplateRenderer(app_path, indexed_locations=['templates']),
+                             TemplateRenderer(app_path, bundle_path=bundle_path)):
+                self.assertEqual(renderer.render('booking/ask'), 'Main')
+                self.assertEqual(renderer.render('booking/ask', tmpl_custom_folders=['organizations/1']), 'Custom')
+
+    def test_variant_selectors(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/a.tmpl': 'A',
+                                      'templates/ru_RU/text/test/b.w3.tmpl': 'B',
+                                      'templates/ru_RU/text/test/c.tmpl': 'C'})
+            renderer = TemplateRenderer(app_path, indexed_locations=['templates'],
+                                        variant_selector=RoundRobinSelector())
+            self.assertEqual([renderer.render('test') for _ in range(4)], ['A', 'B', 'C', 'A'])
+
+            renderer.variant_selector = SeededSelector()
+            first = [renderer.render('test', tmpl_variant_key=key) for key in range(20)]
+            self.assertEqual([renderer.render('test', tmpl_variant_key=key) for key in range(20)], first)
+
+            renderer.variant_selector = UniformSelector(seed=1)
+            first = [renderer.render('test') for _ in range(20)]
+            renderer.variant_selector = UniformSelector(seed=1)
+            self.assertEqual([renderer.render('test') for _ in range(20)], first)
+
+            renderer.variant_selector = WeightedSelector(weights={'a.tmpl': 0}, seed=1)
+            picked = [renderer.render('test') for _ in range(100)]
+            self.assertNotIn('A', picked)
+            self.assertGreater(picked.count('B'), picked.count('C'))
+
+    def test_weighted_selector_rejects_invalid_weights(self):
+        variants = ('/t/a.tmpl', '/t/b.tmpl')
+        with self.assertRaisesRegex(ValueError, 'zero weight'):
+            WeightedSelector(weights={'a.tmpl': 0, 'b.tmpl': 0})(variants)
+        with self.assertRaisesRegex(ValueError, 'negative'):
+            WeightedSelector(weights={'a.tmpl': -1})(variants)
+        with self.assertRaises(TypeError):
+            type('Selector', (VariantSelector,), {})()
+
+    def test_render_result_cache(self):
+        calls = []
+
+        def count(value):
+            calls.append(value)
+            return value
+
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/menu/1.tmpl': '{#- cacheable -#}\nMenu {{count(a)}}',
+                                      'templates/ru_RU/text/greeting/1.tmpl': 'Hello {{count(a)}}'})
+            renderer = TemplateRenderer(app_path, tmpl_globals={'count': count}, result_cache_size=10)
+            self.assertEqual(renderer.render('menu', a='1'), 'Menu 1')
+            self.assertEqual(renderer.render('menu', a='1'), 'Menu 1')
+            self.assertEqual(renderer.render('menu', a='2'), 'Menu 2')
+            self.assertEqual(renderer.render('menu', a=['2']), "Menu ['2']")
+            self.assertEqual(renderer.render('menu', a={'2'}), "Menu {'2'}")
+            self.assertEqual(calls, ['1', '2', ['2'], {'2'}])
+            self.assertEqual((renderer.result_cache.hits, renderer.result_cache.misses), (1, 4))
+
+            renderer.render('greeting', a='1')
+            renderer.render('greeting', a='1')
+            self.assertEqual(len(calls), 6)
+
+            self.assertEqual([renderer.render('menu', a=value) for value in (1, True, 1.0, {'b': 1}, {'b': True})],
+                             ['Menu 1', 'Menu True', 'Menu 1.0', "Menu {'b': 1}", "Menu {'b': True}"])
+
+            class User:
+                name = 'Ann'
+
+                def __str__(self):
+                    return self.name
+            user = User()
+            self.assertEqual(renderer.render('menu', a=user), 'Menu Ann')
+            user.name = 'Bob'
+            self.assertEqual(renderer.render('menu', a=user), 'Menu Bob')
+
+    def test_render_message(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {
+                'templates/ru_RU/text/menu/1.tmpl':
+                    '{"messages": [{"text": "Choose {{a}}"}, {"buttons": [{"button": "Yes"}, {"button": "No"}]}]}',
+                'templates/ru_RU/text/greeting/1.tmpl': 'Hello {{a}}'})
+            renderer = TemplateRenderer(app_path, message_cache_size=10)
+            message = renderer.render_message('menu', a='1')
+            self.assertEqual([type(msg) for msg in message.messages], [TextMessage, ButtonsMessage])
+            self.assertEqual(message.messages[0].text, 'Choose 1')
+            self.assertIs(renderer.render_message('menu', a='1'), message)
+
+            with mock.patch('knosk.core.messages.json.loads') as loads_mock:
+                message = renderer.render_message('greeting', a='1')
+                loads_mock.assert_not_called()
+            self.assertEqual(message.to_dict()['messages'][0]['text'], 'Hello 1')
+
+    def test_render_stats(self):
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {'templates/ru_RU/text/test/1.tmpl': 'Hello {{a}}'})
+            stats = RenderStats()
+            renderer = TemplateRenderer(app_path, stats=stats)
+            renderer.render('test', a='1')
+            renderer.render('test', a='2')
+            template_path = os.path.join(app_path, 'templates/ru_RU/text/test/1.tmpl')
+            self.assertEqual(stats.templates(), [template_path])
+            template_stats = stats.get(template_path)
+            self.assertEqual({phase: histogram.count for phase, histogram in template_stats.phases.items()},
+                             {'resolve': 2, 'load': 2, 'render': 2})
+            self.assertEqual(template_stats.caches['load'].hits, 1)
+            self.assertEqual(template_stats.caches['load'].misses, 1)
+            self.assertNotIn('render', template_stats.caches)
+            self.assertIn('resolve', stats.dump())
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.record(ms / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(50), 0.05)
+        self.assertEqual(histogram.percentile(100), 0.1)
+
+    def test_render_fragment_cache(self):
+        calls = []
+
+        def price_list():
+            calls.append(1)
+            return 'prices'
+
+        async def price_list_async():
+            return price_list()
+
+        with tempfile.TemporaryDirectory() as app_path:
+            make_templates(app_path, {
+                'templates/ru_RU/text/test/1.tmpl': 'Hello {{a}}: {% cache "prices", 60 %}{{prices()}}{% endcache %}',
+                'templates/ru_RU/text/other/1.tmpl': '{% cache "other" %}{{prices()}}{% endcache %}'})
+            renderer = TemplateRenderer(app_path, tmpl_globals={'prices': price_list})
+            self.assertEqual(renderer.render('test', a='1'), 'Hello 1: prices')
+            self.assertEqual(renderer.render('test', a='2'), 'Hello 2: prices')
+            self.assertEqual(renderer.render('other'), 'prices')
+            self.assertEqual(len(calls), 2)
+
+            renderer = TemplateRenderer(app_path, tmpl_globals={'prices': price_list_async})
+            self.assertEqual(run_async(renderer.render_async('test', a='1')), 'Hello 1: prices')
+            self.assertEqual(run_async(renderer.render_async('test', a='2')), 'Hello 2: prices')
+            self.assertEqual(len(calls), 3)
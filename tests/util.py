@@ -1,3 +1,5 @@
+import asyncio
+
 from knosk.fields import DialogField, GroupField, ListField
 from knosk.core import DialogForm
 
@@ -40,3 +42,19 @@ class SimpleForm(DialogForm):
 
     class Meta:
         fields = ('name', 'gp', 'lastnames')
+
+
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def lazy_handler(flow, route_name, payload, ctx):
+    return route_name, payload
+
+
+def lazy_condition(flow, route_name, payload, ctx):
+    return "stopped" if payload.get("stop") else None